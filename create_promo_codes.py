@@ -5,8 +5,12 @@ from __future__ import annotations
 
 import argparse
 import logging
+import re
 import sys
 import time
+from concurrent.futures import ThreadPoolExecutor
+from html import unescape
+from http.cookiejar import MozillaCookieJar
 from pathlib import Path
 from typing import Dict, Iterable, List, Optional, Union
 
@@ -18,18 +22,20 @@ if not logger.handlers:
     logger.addHandler(handler)
 logger.setLevel(logging.INFO)
 
+import requests
 from bs4 import BeautifulSoup  # type: ignore
-from selenium.common.exceptions import NoSuchElementException, TimeoutException  # type: ignore
-from selenium.webdriver.common.by import By  # type: ignore
+from selenium.common.exceptions import TimeoutException  # type: ignore
 from selenium.webdriver.support import expected_conditions as EC  # type: ignore
 from selenium.webdriver.support.ui import WebDriverWait  # type: ignore
 
-from myrace_login import build_form_payload, format_form_fields, parse_html_form
+from myrace_login import build_form_payload, format_form_fields, parse_html_form_from_soup
 from myrace_selenium import (  # type: ignore
+    WAIT_POLL_FREQUENCY,
     add_cookies_to_driver,
+    batch_fill_form_fields,
     build_driver,
     export_cookies,
-    fill_form_fields,
+    find_promo_form,
     maybe_submit_form,
     parse_field_overrides,
     read_netscape_cookies,
@@ -45,6 +51,21 @@ TYPE_SLUGS = {
     "at a certain distance with bib selection": "distance_with_bib",
 }
 
+ACTUAL_CODE_RE = re.compile(r"[A-Z0-9-]{4,16}")
+# Порядок важен: поле относится к первому совпавшему виду.
+FIELD_KIND_PATTERNS = (
+    ("code", re.compile(r"code|key")),
+    ("name", re.compile(r"name|title|label")),
+    ("discount", re.compile(r"discount|percent")),
+    ("deduction", re.compile(r"deduction")),
+    ("usage", re.compile(r"usage|limit|max|count")),
+    ("slot", re.compile(r"slot")),
+)
+CODE_INPUT_RE = re.compile(
+    r"""<input\b(?=[^>]*\s(?:id|name)=["']code["'])[^>]*\svalue=["']([^"']+)["']""",
+    re.IGNORECASE,
+)
+
 
 def parse_args() -> argparse.Namespace:
     parser = argparse.ArgumentParser(
@@ -138,6 +159,17 @@ def parse_args() -> argparse.Namespace:
         action="store_true",
         help="Показать найденные поля формы перед заполнением.",
     )
+    parser.add_argument(
+        "--no-browser",
+        action="store_true",
+        help="Создавать промокоды HTTP-запросами с cookies, без запуска Selenium.",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=4,
+        help="Сколько браузеров запускать параллельно (по умолчанию 4, не больше числа кодов).",
+    )
     parser.add_argument(
         "--step-delay",
         type=float,
@@ -150,7 +182,13 @@ def parse_args() -> argparse.Namespace:
 
 
 def extract_actual_code(html: str) -> Optional[str]:
-    soup = BeautifulSoup(html, "html.parser")
+    # Быстрый путь: поле code с заполненным value находим регуляркой без построения DOM.
+    match = CODE_INPUT_RE.search(html)
+    if match:
+        value = unescape(match.group(1)).strip()
+        if value:
+            return value
+    soup = BeautifulSoup(html, "lxml")
     for selector in ({"id": "code"}, {"name": "code"}):
         field = soup.find("input", selector)
         if field and field.get("value"):
@@ -162,18 +200,29 @@ def extract_actual_code(html: str) -> Optional[str]:
         text_value = anchor.get_text(strip=True)
         if text_value:
             return text_value
-    import re
     for candidate in soup.find_all(string=True):
         stripped = candidate.strip()
-        if not stripped:
-            continue
-        if not re.fullmatch(r"[A-Z0-9-]{4,16}", stripped):
+        if not stripped or stripped == "MYRACE":
             continue
-        if stripped.upper() == "MYRACE":
+        if not ACTUAL_CODE_RE.fullmatch(stripped):
             continue
         return stripped
     return None
 
+
+def classify_form_field(name: str) -> Optional[str]:
+    lower = name.lower()
+    if "authenticity" in lower:
+        return None
+    for kind, pattern in FIELD_KIND_PATTERNS:
+        if not pattern.search(lower):
+            continue
+        if kind == "usage" and "slot" in lower:
+            continue
+        return kind
+    return None
+
+
 def derive_overrides(
     form_fields: Dict[str, object],
     code_value: str,
@@ -182,62 +231,55 @@ def derive_overrides(
     usage_limit: int,
     slot_value: Optional[str],
 ) -> Dict[str, Union[str, List[str]]]:
+    values: Dict[str, Optional[str]] = {
+        "code": code_value,
+        "name": code_value,
+        "discount": str(discount),
+        "deduction": str(deduction),
+        "usage": str(usage_limit),
+        "slot": slot_value,
+    }
     overrides: Dict[str, Union[str, List[str]]] = {}
     for name in form_fields.keys():
-        lower = name.lower()
-        if "authenticity" in lower:
+        kind = classify_form_field(name)
+        if kind is None:
             continue
-        if any(key in lower for key in ("code", "key")):
-            overrides[name] = code_value
-        elif any(key in lower for key in ("name", "title", "label")):
-            overrides[name] = code_value
-        elif "discount" in lower or "percent" in lower:
-            overrides[name] = str(discount)
-        elif "deduction" in lower:
-            overrides[name] = str(deduction)
-        elif any(key in lower for key in ("usage", "limit", "max", "count")) and "slot" not in lower:
-            overrides[name] = str(usage_limit)
-        elif "slot" in lower and slot_value is not None:
-            overrides[name] = slot_value
+        value = values[kind]
+        if value is not None:
+            overrides[name] = value
     return overrides
 
 
+SELECT_ALL_SLOTS_JS = """
+var el = arguments[0].querySelector('#chkAll') || document.getElementById('chkAll');
+if (!el) { return 'missing'; }
+if (el.checked) { return 'already'; }
+el.scrollIntoView({block: 'center'});
+el.click();
+return 'clicked';
+"""
+
+
 def click_select_all_slots(form) -> None:
     driver = getattr(form, "_parent", None)
+    if driver is None:
+        logger.error("Не удалось получить драйвер для формы, #chkAll не выбран.")
+        return
 
-    def _safe_click(element) -> bool:
-        try:
-            if driver:
-                driver.execute_script("arguments[0].scrollIntoView({block: 'center'});", element)
-            element.click()
-            logger.debug("Clicked element %s", element)
-            return True
-        except Exception:
-            if driver:
-                try:
-                    driver.execute_script("arguments[0].click();", element)
-                    logger.debug("Clicked element via JS %s", element)
-                    return True
-                except Exception:  # pylint: disable-broad-except
-                    return False
-            return False
-
+    # Поиск, проверка и клик по #chkAll за один round-trip к драйверу.
     try:
-        master_checkbox = form.find_element(By.ID, "chkAll")
-    except NoSuchElementException:
-        try:
-            master_checkbox = form.find_element(By.CSS_SELECTOR, "input#chkAll")
-        except NoSuchElementException:
-            logger.error("Не найден чекбокс #chkAll для выбора всех слотов.")
-            return
+        status = driver.execute_script(SELECT_ALL_SLOTS_JS, form)
+    except Exception as exc:  # pylint: disable=broad-except
+        logger.error("Не удалось кликнуть по #chkAll (%s). Проверьте вёрстку.", exc)
+        return
 
-    if master_checkbox.is_selected():
+    if status == "missing":
+        logger.error("Не найден чекбокс #chkAll для выбора всех слотов.")
+    elif status == "already":
         logger.info("#chkAll уже выбран.")
-        return
+    else:
+        logger.info("Выбраны все слоты через чекбокс #chkAll.")
 
-    logger.info("Выбираем все слоты через чекбокс #chkAll.")
-    if not _safe_click(master_checkbox):
-        logger.error("Не удалось кликнуть по #chkAll. Проверьте вёрстку.")
 
 def maybe_pause(step_delay: float, label: str) -> None:
     if step_delay > 0:
@@ -264,19 +306,22 @@ def resolve_type_slug(name: str) -> Optional[str]:
     return None
 
 
-def open_slots_form(
-    driver, wait: WebDriverWait, race_id: int, coupon_type_query: str, step_delay: float
-) -> None:
+def build_slots_form_url(race_id: int, coupon_type_query: str) -> str:
     base_url = SLOTS_FORM_URL.format(race_id=race_id)
     slug = resolve_type_slug(coupon_type_query)
     if slug:
-        target = f"{base_url}?type={slug}"
-    else:
-        target = base_url
-        logger.warning(
-            "Не удалось сопоставить тип '%s' со slug. Используем базовый URL.",
-            coupon_type_query,
-        )
+        return f"{base_url}?type={slug}"
+    logger.warning(
+        "Не удалось сопоставить тип '%s' со slug. Используем базовый URL.",
+        coupon_type_query,
+    )
+    return base_url
+
+
+def open_slots_form(
+    driver, wait: WebDriverWait, race_id: int, coupon_type_query: str, step_delay: float
+) -> None:
+    target = build_slots_form_url(race_id, coupon_type_query)
     logger.info("Открываем форму по адресу %s", target)
     logger.info("Step: opening slots form %s", target)
     driver.get(target)
@@ -344,33 +389,18 @@ def create_single_coupon(
 ) -> None:
     maybe_pause(step_delay, "перед заполнением формы")
 
-    def _locate_form(_driver):
-        forms = _driver.find_elements(By.TAG_NAME, "form")
-        for candidate in forms:
-            if not candidate.is_displayed():
-                continue
-            action = (candidate.get_attribute("action") or "").lower()
-            classes = (candidate.get_attribute("class") or "").lower()
-            if any(keyword in action for keyword in ("/promo", "/coupons")):
-                return candidate
-            if "promo" in classes:
-                return candidate
-            try:
-                if candidate.find_elements(By.NAME, "code"):
-                    return candidate
-            except Exception:
-                continue
-        return False
-
     try:
-        form = wait.until(_locate_form)
+        # Видимость и признаки формы проверяются одним execute_script в браузере,
+        # без get_attribute/find_elements по каждой форме через WebDriver.
+        form = wait.until(lambda d: find_promo_form(d) or False)
         logger.info("Найдена форма с action=%s", form.get_attribute("action"))
     except TimeoutException as exc:
         logger.error("Форма создания не найдена. Текущий URL: %s", driver.current_url)
         raise RuntimeError("Не удалось найти форму создания промокода.") from exc
 
-    soup = BeautifulSoup(driver.page_source, "html.parser")
-    form_info = parse_html_form(str(soup), driver.current_url)
+    # Один разбор page_source для полей формы и #chkAll.
+    soup = BeautifulSoup(driver.page_source, "lxml")
+    form_info = parse_html_form_from_soup(soup, driver.current_url)
 
     if preview_fields:
         print("Поля формы:")
@@ -395,9 +425,12 @@ def create_single_coupon(
         )
 
     if slot_value and slot_value.lower() == "all":
-        click_select_all_slots(form)
+        if soup.find("input", id="chkAll") is None:
+            logger.error("Не найден чекбокс #chkAll для выбора всех слотов.")
+        else:
+            click_select_all_slots(form)
 
-    missing = fill_form_fields(form, payload)
+    missing = batch_fill_form_fields(form, payload)
     if missing:
         logger.warning("Не удалось заполнить поля: %s", ", ".join(missing))
 
@@ -422,55 +455,165 @@ def create_single_coupon(
             file=sys.stderr,
         )
     else:
-        actual_code = extract_actual_code(driver.page_source)
-        if actual_code:
-            message = f"Промокод создан: `{actual_code}`"
-            logger.info(
-                "Промокод %s создан успешно (URL: %s, фактический код: %s)",
-                code_value,
-                driver.current_url,
-                actual_code,
-            )
-            print(message)
-            print(f"ACTUAL_CODE:{actual_code}")
-        else:
-            message = f"Промокод {code_value} создан (не удалось определить фактический код)."
-            logger.info(
-                "Промокод %s создан успешно, но не удалось извлечь фактический код (URL: %s)",
-                code_value,
-                driver.current_url,
-            )
-            print(message)
+        report_created_coupon(code_value, driver.current_url, driver.page_source)
 
 
-def main() -> None:
-    args = parse_args()
-    cookies_path = Path(args.cookies).expanduser()
-    driver = build_driver(args.browser, args.headless)
-    wait = WebDriverWait(driver, args.wait)
+def report_created_coupon(code_value: str, current_url: str, html: str) -> None:
+    actual_code = extract_actual_code(html)
+    if actual_code:
+        message = f"Промокод создан: `{actual_code}`"
+        logger.info(
+            "Промокод %s создан успешно (URL: %s, фактический код: %s)",
+            code_value,
+            current_url,
+            actual_code,
+        )
+        print(message)
+        print(f"ACTUAL_CODE:{actual_code}")
+    else:
+        message = f"Промокод {code_value} создан (не удалось определить фактический код)."
+        logger.info(
+            "Промокод %s создан успешно, но не удалось извлечь фактический код (URL: %s)",
+            code_value,
+            current_url,
+        )
+        print(message)
+
+
+def build_http_session(cookies_path: Path) -> requests.Session:
+    session = requests.Session()
+    session.headers.update(
+        {
+            "User-Agent": "Mozilla/5.0 (X11; Linux x86_64) MyRaceHelperBot/1.0",
+            "Accept-Language": "ru-RU,ru;q=0.9,en-US;q=0.8,en;q=0.7",
+        }
+    )
+    jar = MozillaCookieJar(str(cookies_path))
+    jar.load(ignore_discard=True, ignore_expires=True)
+    session.cookies = jar
+    return session
+
+
+def collect_slot_values(soup: BeautifulSoup) -> Dict[str, List[str]]:
+    # Аналог клика по #chkAll: отмечаем все чекбоксы слотов в форме.
+    slots: Dict[str, List[str]] = {}
+    for checkbox in soup.find_all("input", attrs={"type": "checkbox"}):
+        name = checkbox.get("name")
+        if not name or checkbox.get("id") == "chkAll" or "slot" not in name.lower():
+            continue
+        slots.setdefault(name, []).append(checkbox.get("value", "on"))
+    return slots
 
-    logger = logging.getLogger("create_promo")
-    logger.setLevel(logging.DEBUG)
-    if not logging.getLogger().handlers:
-        logging.basicConfig(level=logging.INFO)
 
+def create_single_coupon_http(
+    session: requests.Session,
+    form_url: str,
+    code_value: str,
+    discount: int,
+    deduction: int,
+    usage_limit: int,
+    slot_value: Optional[str],
+    manual_overrides: Dict[str, Union[str, List[str]]],
+    preview_fields: bool,
+    dry_run: bool,
+) -> None:
+    response = session.get(form_url, timeout=30)
+    response.raise_for_status()
+    if "/login" in response.url:
+        raise RuntimeError(
+            "Cookies недействительны (редирект на страницу входа). Обновите их через /setcookies."
+        )
+
+    soup = BeautifulSoup(response.text, "lxml")
+    form_info = parse_html_form_from_soup(soup, response.url)
+
+    if preview_fields:
+        print("Поля формы:")
+        print(format_form_fields(form_info))
+
+    auto = derive_overrides(
+        form_info.fields,
+        code_value,
+        discount,
+        deduction,
+        usage_limit,
+        slot_value,
+    )
+    if slot_value and slot_value.lower() == "all":
+        slots = collect_slot_values(soup)
+        if not slots:
+            logger.error("Не найдены чекбоксы слотов для выбора всех слотов.")
+        auto.update(slots)
+    auto.update(manual_overrides)
+
+    payload, missing_defaults = build_form_payload(form_info, auto)
+    if missing_defaults:
+        print(
+            "Предупреждение: обязательные поля остались пустыми: "
+            + ", ".join(missing_defaults),
+            file=sys.stderr,
+        )
+
+    if dry_run:
+        print(f"[dry-run] Форма для {code_value} заполнена, но не отправлена.")
+        logger.info("[dry-run] Данные формы для %s: %s", code_value, payload)
+        return
+
+    result = session.post(form_info.action, data=payload, timeout=30)
+    result.raise_for_status()
+    if "promo/view" not in result.url and "race/coupons/list" not in result.url:
+        logger.warning(
+            "Не удалось подтвердить успешное создание %s. Текущий URL: %s",
+            code_value,
+            result.url,
+        )
+        print(
+            f"Предупреждение: не удалось подтвердить успешное создание {code_value}. Проверьте вручную.",
+            file=sys.stderr,
+        )
+        return
+    report_created_coupon(code_value, result.url, result.text)
+
+
+def create_codes_with_http(
+    args: argparse.Namespace,
+    cookies_path: Path,
+    manual_overrides: Dict[str, Union[str, List[str]]],
+) -> None:
+    session = build_http_session(cookies_path)
+    form_url = build_slots_form_url(args.race_id, args.coupon_type)
+    for code_value in args.codes:
+        print(f"Создаём промокод {code_value}…")
+        logger.info("Создаём промокод %s без браузера", code_value)
+        create_single_coupon_http(
+            session=session,
+            form_url=form_url,
+            code_value=code_value,
+            discount=args.discount,
+            deduction=args.deduction,
+            usage_limit=args.usage_limit,
+            slot_value=args.slot_value,
+            manual_overrides=manual_overrides,
+            preview_fields=args.show_fields,
+            dry_run=args.dry_run,
+        )
+
+
+def create_codes_with_driver(
+    args: argparse.Namespace,
+    cookies: List[Dict[str, Union[str, int, bool]]],
+    codes: List[str],
+    manual_overrides: Dict[str, Union[str, List[str]]],
+    cookies_path: Optional[Path] = None,
+) -> None:
+    driver = build_driver(args.browser, args.headless)
+    wait = WebDriverWait(driver, args.wait, poll_frequency=WAIT_POLL_FREQUENCY)
     try:
-        logger.info("Используем cookies из %s", cookies_path)
-        if not cookies_path.exists():
-            raise RuntimeError(
-                f"Файл cookies {cookies_path} не найден. Добавьте его через /setcookies."
-            )
-        cookies = read_netscape_cookies(cookies_path)
-        logger.info("Загружено %d cookie", len(cookies))
         add_cookies_to_driver(driver, cookies)
 
         open_slots_form(driver, wait, args.race_id, args.coupon_type, args.step_delay)
 
-        manual_overrides = parse_field_overrides(args.field)
-        if manual_overrides:
-            logger.info("Ручные переопределения полей: %s", manual_overrides)
-
-        for code_value in args.codes:
+        for code_value in codes:
             print(f"Создаём промокод {code_value}…")
             logger.info("Создаём промокод %s", code_value)
             create_single_coupon(
@@ -486,14 +629,67 @@ def main() -> None:
                 dry_run=args.dry_run,
                 step_delay=args.step_delay,
             )
-            time.sleep(1)
 
-        if args.save_cookies:
+        if cookies_path is not None:
             export_cookies(driver, cookies_path)
     finally:
         if not args.keep_open:
             driver.quit()
 
 
+def main() -> None:
+    args = parse_args()
+    cookies_path = Path(args.cookies).expanduser()
+
+    logger = logging.getLogger("create_promo")
+    logger.setLevel(logging.DEBUG)
+    if not logging.getLogger().handlers:
+        logging.basicConfig(level=logging.INFO)
+
+    logger.info("Используем cookies из %s", cookies_path)
+    if not cookies_path.exists():
+        raise RuntimeError(
+            f"Файл cookies {cookies_path} не найден. Добавьте его через /setcookies."
+        )
+    cookies = read_netscape_cookies(cookies_path)
+    logger.info("Загружено %d cookie", len(cookies))
+
+    manual_overrides = parse_field_overrides(args.field)
+    if manual_overrides:
+        logger.info("Ручные переопределения полей: %s", manual_overrides)
+
+    if args.no_browser:
+        create_codes_with_http(args, cookies_path, manual_overrides)
+        return
+
+    export_path = cookies_path if args.save_cookies else None
+    workers = max(1, min(args.workers, len(args.codes)))
+    if workers == 1:
+        create_codes_with_driver(args, cookies, args.codes, manual_overrides, export_path)
+        return
+
+    # Каждый поток работает со своим браузером и своей частью кодов;
+    # cookies читаются один раз и раздаются всем драйверам.
+    logger.info("Создаём %d промокодов в %d потоках", len(args.codes), workers)
+    batches = [args.codes[index::workers] for index in range(workers)]
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [
+            executor.submit(
+                create_codes_with_driver,
+                args,
+                cookies,
+                batch,
+                manual_overrides,
+                export_path if index == 0 else None,
+            )
+            for index, batch in enumerate(batches)
+        ]
+    errors = [future.exception() for future in futures if future.exception()]
+    for exc in errors[1:]:
+        logger.error("Ошибка в потоке создания промокодов: %s", exc)
+    if errors:
+        raise errors[0]
+
+
 if __name__ == "__main__":
     main()
@@ -5,12 +5,23 @@ from __future__ import annotations
 
 import json
 import os
+import threading
 from decimal import Decimal
 from pathlib import Path
-from typing import Dict, Optional
+from typing import Dict, Optional, Tuple
+
+try:
+    import orjson  # type: ignore
+except ImportError:  # pragma: no cover
+    orjson = None
 
 DEFAULT_GOALS_PATH = "data/income_goals.json"
 
+# Кэш разобранных целей: путь -> (mtime_ns, цели). Бот читает цели из to_thread,
+# поэтому доступ к кэшу защищён блокировкой.
+_GOALS_CACHE: Dict[Path, Tuple[int, Dict[str, Decimal]]] = {}
+_GOALS_CACHE_LOCK = threading.Lock()
+
 
 def get_income_goals_path() -> Path:
     return Path(os.getenv("MYRACE_GOALS_PATH", DEFAULT_GOALS_PATH)).expanduser()
@@ -20,27 +31,53 @@ def _load_raw_goals(path: Path) -> Dict[str, str]:
     if not path.exists():
         return {}
     try:
-        with path.open("r", encoding="utf-8") as handle:
-            data = json.load(handle)
+        if orjson is not None:
+            data = orjson.loads(path.read_bytes())
+        else:
+            with path.open("r", encoding="utf-8") as handle:
+                data = json.load(handle)
     except (json.JSONDecodeError, OSError):
         return {}
     if isinstance(data, dict):
-        return {str(key): str(value) for key, value in data.items()}
+        # Ключи JSON-объекта всегда строки; значения приводим к str, чтобы
+        # числа из файла не превращались в Decimal через float.
+        return {key: str(value) for key, value in data.items()}
     return {}
 
 
-def load_income_goals(path: Optional[Path] = None) -> Dict[str, Decimal]:
-    target_path = path or get_income_goals_path()
-    raw = _load_raw_goals(target_path)
+def _parse_goals(raw: Dict[str, str]) -> Dict[str, Decimal]:
     goals: Dict[str, Decimal] = {}
     for race_id, value in raw.items():
         try:
-            goals[str(race_id)] = Decimal(str(value))
+            goals[race_id] = Decimal(value)
         except Exception:
             continue
     return goals
 
 
+def _invalidate_goals_cache(path: Path) -> None:
+    with _GOALS_CACHE_LOCK:
+        _GOALS_CACHE.pop(path, None)
+
+
+def load_income_goals(path: Optional[Path] = None) -> Dict[str, Decimal]:
+    target_path = path or get_income_goals_path()
+    try:
+        mtime_ns = target_path.stat().st_mtime_ns
+    except OSError:
+        _invalidate_goals_cache(target_path)
+        return {}
+    with _GOALS_CACHE_LOCK:
+        cached = _GOALS_CACHE.get(target_path)
+    if cached and cached[0] == mtime_ns:
+        return dict(cached[1])
+
+    goals = _parse_goals(_load_raw_goals(target_path))
+    with _GOALS_CACHE_LOCK:
+        _GOALS_CACHE[target_path] = (mtime_ns, goals)
+    return dict(goals)
+
+
 def upsert_income_goal(
     race_id: str,
     amount: Optional[Decimal],
@@ -53,6 +90,17 @@ def upsert_income_goal(
     else:
         raw[race_id] = str(amount)
     target_path.parent.mkdir(parents=True, exist_ok=True)
-    with target_path.open("w", encoding="utf-8") as handle:
-        json.dump(raw, handle, ensure_ascii=False, indent=2, sort_keys=True)
-    return load_income_goals(target_path)
+    # Пишем во временный файл и подменяем атомарно, чтобы планировщик
+    # не прочитал наполовину записанный JSON.
+    tmp_path = target_path.with_suffix(target_path.suffix + ".tmp")
+    if orjson is not None:
+        tmp_path.write_bytes(orjson.dumps(raw, option=orjson.OPT_INDENT_2 | orjson.OPT_SORT_KEYS))
+    else:
+        with tmp_path.open("w", encoding="utf-8") as handle:
+            json.dump(raw, handle, ensure_ascii=False, indent=2, sort_keys=True)
+    tmp_path.replace(target_path)
+
+    goals = _parse_goals(raw)
+    with _GOALS_CACHE_LOCK:
+        _GOALS_CACHE[target_path] = (target_path.stat().st_mtime_ns, goals)
+    return dict(goals)
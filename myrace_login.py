@@ -9,16 +9,20 @@ from html import unescape
 from typing import Callable, Dict, List, Optional, Tuple, Union
 from urllib.parse import urljoin
 
-from bs4 import BeautifulSoup  # type: ignore
+from bs4 import BeautifulSoup, SoupStrainer  # type: ignore
 
 BASE_URL = "https://myrace.info"
 LOGIN_URL = f"{BASE_URL}/login/"
 
 HIDDEN_INPUT_RE = re.compile(r'name="(?P<name>[^"]+)"[^>]*value="(?P<value>[^"]*)"')
-HEADING_RE = re.compile(r"<h1[^>]*>([^<]+)</h1>")
+HEADING_RE = re.compile(r"<h1[^>]*>(.*?)</h1>", re.IGNORECASE | re.DOTALL)
+TAG_RE = re.compile(r"<[^>]+>")
+# Для разбора форм строим дерево только из <form>, остальная страница не нужна.
+FORM_STRAINER = SoupStrainer("form")
+PREFERRED_CODE_FIELDS = frozenset(("code", "token", "otp", "pin", "verificationcode", "verifycode"))
 
 
-@dataclass
+@dataclass(slots=True)
 class FormField:
     name: str
     value: Union[str, List[str], None]
@@ -28,7 +32,7 @@ class FormField:
     options: List[str] = field(default_factory=list)
 
 
-@dataclass
+@dataclass(slots=True)
 class FormInfo:
     action: str
     method: str
@@ -43,10 +47,70 @@ def extract_hidden_value(html: str, field_name: str) -> Optional[str]:
 
 
 def extract_heading(html: str) -> Optional[str]:
+    # Регулярка вместо разбора дерева; вложенные теги (<span>, <a>) внутри
+    # заголовка просто вырезаем.
     match = HEADING_RE.search(html)
     if not match:
         return None
-    return unescape(match.group(1)).strip()
+    text = unescape(TAG_RE.sub("", match.group(1))).strip()
+    return " ".join(text.split()) or None
+
+
+def _add_form_field(
+    fields: Dict[str, FormField],
+    name: Optional[str],
+    value: Union[str, List[str], None],
+    field_type: str,
+    required: bool = False,
+    multiple: bool = False,
+    options: Optional[List[str]] = None,
+) -> None:
+    if not name:
+        return
+    multiple = multiple or field_type in ("checkbox", "radio")
+
+    existing = fields.get(name)
+    if existing is not None:
+        existing.multiple = existing.multiple or multiple
+        existing.required = existing.required or required
+        if existing.multiple:
+            merged = existing.value if isinstance(existing.value, list) else []
+            if isinstance(value, list):
+                merged.extend([item for item in value if item not in (None, "")])
+            elif value not in (None, ""):
+                merged.append(value)
+            existing.value = merged
+        elif isinstance(value, list):
+            existing.value = value[-1] if value else existing.value
+        elif value is not None:
+            existing.value = value
+        if options:
+            for option in options:
+                if option not in existing.options:
+                    existing.options.append(option)
+        return
+
+    base_value: Union[str, List[str]]
+    if multiple:
+        if isinstance(value, list):
+            base_value = [item for item in value if item not in (None, "")]
+        elif value in (None, ""):
+            base_value = []
+        else:
+            base_value = [value]
+    elif isinstance(value, list):
+        base_value = value[-1] if value else ""
+    else:
+        base_value = "" if value is None else value
+
+    fields[name] = FormField(
+        name=name,
+        value=base_value,
+        field_type=field_type,
+        required=required,
+        multiple=multiple,
+        options=list(options) if options else [],
+    )
 
 
 def _extract_form_info(form, base_url: str) -> FormInfo:
@@ -56,99 +120,41 @@ def _extract_form_info(form, base_url: str) -> FormInfo:
 
     fields: Dict[str, FormField] = {}
 
-    def add_field(
-        name: Optional[str],
-        value: Union[str, List[str], None],
-        field_type: str,
-        required: bool = False,
-        multiple: bool = False,
-        options: Optional[List[str]] = None,
-    ) -> None:
-        if not name:
-            return
-        options = options or []
-        multiple = multiple or field_type in {"checkbox", "radio"}
-
-        if name in fields:
-            field = fields[name]
-            field.multiple = field.multiple or multiple
-            field.required = field.required or required
-            if field.multiple:
-                existing = field.value if isinstance(field.value, list) else []
-                if not isinstance(existing, list):
-                    existing = [] if existing in (None, "", []) else [existing]
-                if isinstance(value, list):
-                    existing.extend([item for item in value if item not in (None, "")])
-                elif value not in (None, ""):
-                    existing.append(value)
-                field.value = existing
-            elif isinstance(value, list):
-                field.value = value[-1] if value else field.value
-            elif value is not None:
-                field.value = value
-            for option in options:
-                if option not in field.options:
-                    field.options.append(option)
-            return
-
-        if multiple:
-            if isinstance(value, list):
-                base_value = [item for item in value if item not in (None, "")]
-            elif value in (None, ""):
-                base_value = []
-            else:
-                base_value = [value]
-        else:
-            if isinstance(value, list):
-                base_value = value[-1] if value else ""
-            elif value is None:
-                base_value = ""
-            else:
-                base_value = value
-
-        fields[name] = FormField(
-            name=name,
-            value=base_value,
-            field_type=field_type,
-            required=required,
-            multiple=multiple,
-            options=list(options),
-        )
-
     for input_tag in form.find_all("input"):
-        name = input_tag.get("name")
-        field_type = input_tag.get("type", "text").lower()
-        required = input_tag.has_attr("required")
+        attrs = input_tag.attrs
+        field_type = attrs.get("type", "text").lower()
+        checked = "checked" in attrs
 
         if field_type == "checkbox":
-            value = input_tag.get("value", "on") if input_tag.has_attr("checked") else None
+            value = attrs.get("value", "on") if checked else None
         elif field_type == "radio":
-            value = input_tag.get("value", "")
-            if not input_tag.has_attr("checked"):
-                value = None
+            value = attrs.get("value", "") if checked else None
         else:
-            value = input_tag.get("value", "")
+            value = attrs.get("value", "")
 
-        add_field(name, value, field_type, required=required)
+        _add_form_field(fields, attrs.get("name"), value, field_type, required="required" in attrs)
 
     for textarea in form.find_all("textarea"):
-        name = textarea.get("name")
-        required = textarea.has_attr("required")
-        value = textarea.text or ""
-        add_field(name, value, "textarea", required=required)
+        attrs = textarea.attrs
+        _add_form_field(
+            fields,
+            attrs.get("name"),
+            textarea.text or "",
+            "textarea",
+            required="required" in attrs,
+        )
 
     for select in form.find_all("select"):
-        name = select.get("name")
-        required = select.has_attr("required")
-        multiple = select.has_attr("multiple")
+        attrs = select.attrs
+        multiple = "multiple" in attrs
         options: List[str] = []
         selected_values: List[str] = []
         for option in select.find_all("option"):
-            opt_value = option.get("value")
+            opt_value = option.attrs.get("value")
             if opt_value is None:
                 opt_value = option.text
             options.append(opt_value)
-            if option.has_attr("selected"):
+            if "selected" in option.attrs:
                 selected_values.append(opt_value)
 
         if not selected_values:
@@ -159,7 +165,15 @@ def _extract_form_info(form, base_url: str) -> FormInfo:
         else:
             value = selected_values if multiple else selected_values[0]
 
-        add_field(name, value, "select", required=required, multiple=multiple, options=options)
+        _add_form_field(
+            fields,
+            attrs.get("name"),
+            value,
+            "select",
+            required="required" in attrs,
+            multiple=multiple,
+            options=options,
+        )
 
     return FormInfo(action=action, method=method, fields=fields)
 
@@ -169,7 +183,15 @@ def parse_html_forms(
     base_url: str,
     predicate: Optional[Callable[[FormInfo], bool]] = None,
 ) -> List[FormInfo]:
-    soup = BeautifulSoup(html, "html.parser")
+    soup = BeautifulSoup(html, "lxml", parse_only=FORM_STRAINER)
+    return parse_html_forms_from_soup(soup, base_url, predicate=predicate)
+
+
+def parse_html_forms_from_soup(
+    soup: BeautifulSoup,
+    base_url: str,
+    predicate: Optional[Callable[[FormInfo], bool]] = None,
+) -> List[FormInfo]:
     results: List[FormInfo] = []
     for form in soup.find_all("form"):
         info = _extract_form_info(form, base_url)
@@ -184,10 +206,22 @@ def parse_html_form(
     base_url: str,
     predicate: Optional[Callable[[FormInfo], bool]] = None,
 ) -> FormInfo:
-    forms = parse_html_forms(html, base_url, predicate=predicate)
-    if not forms:
-        raise RuntimeError("Не удалось найти подходящую форму в ответе сервера.")
-    return forms[0]
+    # Останавливаемся на первой подходящей форме, не собирая FormInfo для остальных.
+    soup = BeautifulSoup(html, "lxml", parse_only=FORM_STRAINER)
+    return parse_html_form_from_soup(soup, base_url, predicate=predicate)
+
+
+def parse_html_form_from_soup(
+    soup: BeautifulSoup,
+    base_url: str,
+    predicate: Optional[Callable[[FormInfo], bool]] = None,
+) -> FormInfo:
+    for form in soup.find_all("form"):
+        info = _extract_form_info(form, base_url)
+        if predicate and not predicate(info):
+            continue
+        return info
+    raise RuntimeError("Не удалось найти подходящую форму в ответе сервера.")
 
 
 def parse_field_overrides(items: List[str]) -> Dict[str, Union[str, List[str]]]:
@@ -280,9 +314,8 @@ def has_password_field(form_info: FormInfo) -> bool:
 
 
 def guess_code_field(form_info: FormInfo) -> Optional[str]:
-    preferred = ("code", "token", "otp", "pin", "verificationcode", "verifycode")
     for field in form_info.fields.values():
-        if field.name.lower() in preferred:
+        if field.name.lower() in PREFERRED_CODE_FIELDS:
             return field.name
     for field in form_info.fields.values():
         if field.field_type in {"text", "number", "tel", "password"}:
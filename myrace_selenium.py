@@ -6,11 +6,12 @@ from __future__ import annotations
 import argparse
 import os
 import sys
-import time
+from functools import lru_cache
+from http.cookiejar import Cookie, MozillaCookieJar
 from pathlib import Path
-from typing import Dict, List, Optional, Union
+from typing import Dict, List, Optional, Tuple, Union
+from urllib.parse import urlparse
 
-from bs4 import BeautifulSoup  # type: ignore
 from selenium import webdriver  # type: ignore
 from selenium.common.exceptions import NoSuchElementException, TimeoutException  # type: ignore
 from selenium.webdriver import ChromeOptions, FirefoxOptions  # type: ignore
@@ -36,6 +37,12 @@ from myrace_login import (  # type: ignore
 
 DEFAULT_COUPON_LIST = "https://myrace.info/race/coupons/list/{race_id}"
 COUPON_TYPES_URL = "https://myrace.info/coupon/races/{race_id}/types"
+# Ожидания в основном ждут смены DOM после клика; 0.5 с по умолчанию слишком грубо.
+WAIT_POLL_FREQUENCY = 0.1
+COUPON_TYPE_ALIASES = {
+    "на определенную дистанцию": ("at a certain distance",),
+    "на определенную дистанцию с выделением номера": ("at a certain distance with bib selection",),
+}
 
 
 def parse_args() -> argparse.Namespace:
@@ -131,6 +138,14 @@ def build_driver(browser: str, headless: bool) -> webdriver.Remote:
         options.add_argument("--window-size=1400,900")
         options.add_argument("--disable-gpu")
         options.add_argument("--no-sandbox")
+        # Картинки не нужны для заполнения форм — не тратим на них время загрузки.
+        # Стили не отключаем: без CSS скрытые формы и поля выглядят видимыми.
+        options.add_argument("--blink-settings=imagesEnabled=false")
+        options.add_experimental_option(
+            "prefs",
+            {"profile.managed_default_content_settings.images": 2},
+        )
+        options.add_experimental_option("excludeSwitches", ["enable-automation"])
         if chrome_binary:
             options.binary_location = chrome_binary
         if chromedriver_path and Path(chromedriver_path).exists():
@@ -141,6 +156,7 @@ def build_driver(browser: str, headless: bool) -> webdriver.Remote:
         options = FirefoxOptions()
         if headless:
             options.add_argument("-headless")
+        options.set_preference("permissions.default.image", 2)
         if gecko_binary:
             options.binary_location = gecko_binary
         if geckodriver_path and Path(geckodriver_path).exists():
@@ -156,10 +172,10 @@ def read_netscape_cookies(path: Path) -> List[Dict[str, Union[str, int, bool]]]:
     cookies: List[Dict[str, Union[str, int, bool]]] = []
     with path.open("r", encoding="utf-8") as handle:
         for raw_line in handle:
-            line = raw_line.strip()
-            if not line or line.startswith("#"):
+            line = raw_line.rstrip("\r\n")
+            if not line.strip() or (line.startswith("#") and not line.startswith("#HttpOnly_")):
                 continue
-            parts = line.split("\t")
+            parts = line.split("\t", 6)
             if len(parts) != 7:
                 continue
             domain, tailmatch, path_value, secure_flag, expires, name, value = parts
@@ -185,61 +201,97 @@ def read_netscape_cookies(path: Path) -> List[Dict[str, Union[str, int, bool]]]:
     return cookies
 
 
+# Все cookies текущего домена выставляются одним execute_script; в ответ
+# возвращаются имена, которые не попали в document.cookie.
+SET_COOKIES_JS = """
+var cookies = arguments[0];
+cookies.forEach(function (c) {
+    var parts = [c.name + '=' + c.value, 'path=' + c.path];
+    if (!c.hostOnly) { parts.push('domain=' + c.domain); }
+    if (c.expiry) { parts.push('expires=' + new Date(c.expiry * 1000).toUTCString()); }
+    if (c.secure) { parts.push('Secure'); }
+    document.cookie = parts.join('; ');
+});
+var present = {};
+document.cookie.split(';').forEach(function (item) {
+    var name = item.split('=')[0].trim();
+    if (name) { present[name] = true; }
+});
+return cookies.filter(function (c) { return !present[c.name]; }).map(function (c) { return c.name; });
+"""
+
+
+def _add_cookie_via_driver(driver: webdriver.Remote, cookie: Dict[str, Union[str, int, bool]]) -> None:
+    data = {
+        "name": cookie["name"],
+        "value": cookie["value"],
+        "domain": cookie["domain"],
+        "path": cookie["path"],
+        "secure": bool(cookie.get("secure", False)),
+    }
+    expiry = cookie.get("expiry")
+    if isinstance(expiry, int) and expiry > 0:
+        data["expiry"] = expiry
+    try:
+        driver.add_cookie(data)
+    except Exception as exc:  # pylint: disable=broad-except
+        print(f"Не удалось добавить cookie {cookie['name']}: {exc}", file=sys.stderr)
+
+
 def add_cookies_to_driver(driver: webdriver.Remote, cookies: List[Dict[str, Union[str, int, bool]]]) -> None:
     driver.delete_all_cookies()
+    # driver.get сам дожидается document.readyState == "complete".
     driver.get(BASE_URL)
-    time.sleep(1)
+    host = urlparse(driver.current_url).hostname or ""
+    scripted: List[Dict[str, Union[str, int, bool]]] = []
+    remaining: List[Dict[str, Union[str, int, bool]]] = []
     for cookie in cookies:
-        data = {
-            "name": cookie["name"],
-            "value": cookie["value"],
-            "domain": cookie["domain"],
-            "path": cookie["path"],
-            "secure": bool(cookie.get("secure", False)),
-        }
-        expiry = cookie.get("expiry")
-        if isinstance(expiry, int) and expiry > 0:
-            data["expiry"] = expiry
+        domain = str(cookie["domain"])
+        same_host = host == domain or host.endswith("." + domain)
+        # HttpOnly из JS не выставить, чужие домены тоже - их отдаём add_cookie.
+        if same_host and not cookie.get("httpOnly"):
+            scripted.append(cookie)
+        else:
+            remaining.append(cookie)
+    if scripted:
         try:
-            driver.add_cookie(data)
-        except Exception as exc:  # pylint: disable=broad-except
-            print(f"Не удалось добавить cookie {cookie['name']}: {exc}", file=sys.stderr)
+            failed = set(driver.execute_script(SET_COOKIES_JS, scripted) or [])
+        except Exception:  # pylint: disable=broad-except
+            failed = {cookie["name"] for cookie in scripted}
+        remaining.extend(cookie for cookie in scripted if cookie["name"] in failed)
+    for cookie in remaining:
+        _add_cookie_via_driver(driver, cookie)
     driver.get(BASE_URL)
 
 
 def export_cookies(driver: webdriver.Remote, path: Path) -> None:
-    cookies = driver.get_cookies()
-    lines = [
-        "# Netscape HTTP Cookie File",
-        "# Exported from Selenium session",
-    ]
-    for cookie in cookies:
-        domain = cookie.get("domain", "")
-        tailmatch = "FALSE" if domain and not domain.startswith(".") else "TRUE"
-        domain_output = domain if domain else "myrace.info"
-        if not domain_output.startswith("."):
-            domain_output = "." + domain_output
-        path_value = cookie.get("path", "/")
-        secure_flag = "TRUE" if cookie.get("secure") else "FALSE"
-        expiry = cookie.get("expiry", 0)
-        name = cookie.get("name", "")
-        value = cookie.get("value", "")
-        lines.append(
-            "\t".join(
-                [
-                    domain_output,
-                    tailmatch,
-                    path_value,
-                    secure_flag,
-                    str(expiry or 0),
-                    name,
-                    value,
-                ]
+    # MozillaCookieJar пишет тот же формат, что читают _load_cookies и
+    # read_netscape_cookies (включая согласованность домена и флага tailmatch).
+    jar = MozillaCookieJar(str(path))
+    for cookie in driver.get_cookies():
+        domain = cookie.get("domain") or "myrace.info"
+        expiry = cookie.get("expiry")
+        jar.set_cookie(
+            Cookie(
+                version=0,
+                name=cookie.get("name", ""),
+                value=cookie.get("value", ""),
+                port=None,
+                port_specified=False,
+                domain=domain,
+                domain_specified=domain.startswith("."),
+                domain_initial_dot=domain.startswith("."),
+                path=cookie.get("path", "/"),
+                path_specified=True,
+                secure=bool(cookie.get("secure")),
+                expires=int(expiry) if expiry else None,
+                discard=not expiry,
+                comment=None,
+                comment_url=None,
+                rest={},
             )
         )
-    with path.open("w", encoding="utf-8") as handle:
-        handle.write("\n".join(lines))
-        handle.write("\n")
+    jar.save(ignore_discard=True, ignore_expires=True)
     print(f"Cookies сохранены в {path}")
 
 
@@ -276,8 +328,7 @@ def maybe_fill_password(driver: webdriver.Remote, wait: WebDriverWait, email: st
         )
     except TimeoutException:
         return False
-    soup = BeautifulSoup(driver.page_source, "html.parser")
-    forms = parse_html_forms(str(soup), driver.current_url)
+    forms = parse_html_forms(driver.page_source, driver.current_url)
     password_info = None
     for info in forms:
         if has_password_field(info):
@@ -307,8 +358,7 @@ def maybe_fill_otp(driver: webdriver.Remote, wait: WebDriverWait, provided_code:
         )
     except TimeoutException:
         return
-    soup = BeautifulSoup(driver.page_source, "html.parser")
-    info = parse_html_form(str(soup), driver.current_url)
+    info = parse_html_form(driver.page_source, driver.current_url)
     code_field = guess_code_field(info)
     if not code_field:
         raise RuntimeError("Не удалось определить поле для ввода кода подтверждения.")
@@ -330,72 +380,106 @@ def ensure_access(driver: webdriver.Remote, wait: WebDriverWait, url: str) -> No
         raise RuntimeError(f"Редирект на страницу логина ({current}).")
 
 
+# Поиск и клик по типу промокода за один execute_script вместо
+# отдельного запроса к драйверу на каждый атрибут каждого элемента.
+SELECT_COUPON_TYPE_JS = """
+var needles = arguments[0];
+var elements = document.querySelectorAll('a,button,div');
+var available = [];
+for (var i = 0; i < elements.length; i++) {
+    var el = elements[i];
+    // innerText, как element.text: только видимый текст, без скрытых потомков и <script>.
+    var text = (el.innerText || '').trim();
+    var lowered = text.toLowerCase();
+    var matched = needles.some(function (n) { return lowered.indexOf(n) !== -1; });
+    var href = '';
+    var hxGet = '';
+    if (!matched) {
+        // Атрибуты нужны только если не совпал сам текст.
+        href = el.getAttribute('href') ? el.href : '';
+        hxGet = el.getAttribute('hx-get') || el.getAttribute('data-hx-get') || '';
+        var parts = [href, hxGet,
+                     el.getAttribute('data-action') || '', el.getAttribute('data-name') || ''];
+        var combined = parts.filter(function (p) { return p; }).join(' ').toLowerCase();
+        matched = needles.some(function (n) { return combined.indexOf(n) !== -1; });
+    }
+    if (matched) {
+        el.click();
+        return true;
+    }
+    var label = text || href || hxGet;
+    if (label) { available.push(label); }
+}
+return available;
+"""
+
+
+# Первая видимая форма промокода: скрытые шаблоны и формы из неактивных
+# вкладок пропускаем, как это делал is_displayed().
+PROMO_FORM_JS = """
+return Array.prototype.find.call(document.querySelectorAll('form'), function (f) {
+    if (f.getClientRects().length === 0 || getComputedStyle(f).visibility === 'hidden') { return false; }
+    var action = (f.getAttribute('action') || '').toLowerCase();
+    if (action.indexOf('/promo') !== -1 || action.indexOf('/coupons') !== -1) { return true; }
+    if ((f.getAttribute('class') || '').toLowerCase().indexOf('promo') !== -1) { return true; }
+    return f.querySelector('[name="code"]') !== null;
+}) || null;
+"""
+
+
+def find_promo_form(driver: webdriver.Remote) -> Optional[object]:
+    return driver.execute_script(PROMO_FORM_JS)
+
+
+@lru_cache(maxsize=64)
+def _expand_coupon_type_needles(value: str) -> Tuple[str, ...]:
+    expanded = {segment.strip().lower() for segment in value.split("|") if segment.strip()}
+    for key, variations in COUPON_TYPE_ALIASES.items():
+        if key in expanded:
+            expanded.update(variations)
+    # Длинные варианты первыми: они специфичнее и чаще совпадают сразу.
+    return tuple(sorted(expanded, key=len, reverse=True))
+
+
+def _wait_for_coupon_form(driver: webdriver.Remote, wait: WebDriverWait, old_url: str) -> None:
+    # Тип промокода открывается либо переходом, либо htmx-подгрузкой формы.
+    # Любая форма не годится: на странице выбора типа уже бывают формы поиска
+    # или выхода, поэтому ждём именно форму промокода.
+    try:
+        wait.until(lambda d: d.current_url != old_url or find_promo_form(d) is not None)
+    except TimeoutException:
+        print(
+            f"Форма промокода не появилась после выбора типа (URL: {driver.current_url}).",
+            file=sys.stderr,
+        )
+
+
 def select_coupon_type(driver: webdriver.Remote, wait: WebDriverWait, race_id: int, needle: str) -> None:
     target_url = COUPON_TYPES_URL.format(race_id=race_id)
     driver.get(target_url)
     wait.until(EC.presence_of_all_elements_located((By.CSS_SELECTOR, "a, button")))
-    def expand_needles(value: str) -> List[str]:
-        base = [segment.strip().lower() for segment in value.split("|") if segment.strip()]
-        expanded = set(base)
-        aliases = {
-            "на определенную дистанцию": ["at a certain distance"],
-            "на определенную дистанцию с выделением номера": [
-                "at a certain distance with bib selection"
-            ],
-        }
-        for key, variations in aliases.items():
-            if key in expanded:
-                expanded.update(var.lower() for var in variations)
-        return list(expanded)
-
-    needle_variants = expand_needles(needle)
-    candidates = driver.find_elements(By.CSS_SELECTOR, "a, button, div")
-    for element in candidates:
-        text = (element.text or "").strip()
-        inner = (element.get_attribute("innerText") or "").strip()
-        href = element.get_attribute("href") or ""
-        hx_get = element.get_attribute("hx-get") or element.get_attribute("data-hx-get") or ""
-        data_action = element.get_attribute("data-action") or ""
-        data_name = element.get_attribute("data-name") or ""
-        combined = " ".join(
-            filter(
-                None,
-                [
-                    text,
-                    inner,
-                    href,
-                    hx_get,
-                    data_action,
-                    data_name,
-                ],
-            )
-        ).lower()
-        if any(option in combined for option in needle_variants):
-            try:
-                driver.execute_script("arguments[0].click();", element)
-            except Exception:
-                element.click()
-            time.sleep(1)
-            return
-    available: List[str] = []
-    for el in candidates:
-        label = (el.text or el.get_attribute("innerText") or "").strip()
-        href = el.get_attribute("href") or ""
-        hx_get = el.get_attribute("hx-get") or el.get_attribute("data-hx-get") or ""
-        combined_label = label or href or hx_get
-        if combined_label:
-            available.append(combined_label)
+    needle_variants = _expand_coupon_type_needles(needle)
+    old_url = driver.current_url
+    result = driver.execute_script(SELECT_COUPON_TYPE_JS, list(needle_variants))
+    if result is True:
+        _wait_for_coupon_form(driver, wait, old_url)
+        return
+    available = list(result or [])
     raise RuntimeError(
         f"Не найден тип промокода, содержащий '{needle}'. Доступные элементы: {available}"
     )
 
 
+VISIBLE_FORM_JS = """
+return Array.prototype.find.call(document.querySelectorAll('form'), function (f) {
+    return f.offsetParent !== null && getComputedStyle(f).visibility !== 'hidden';
+}) || null;
+"""
+
+
 def get_visible_form(driver: webdriver.Remote) -> Optional[object]:
-    forms = driver.find_elements(By.TAG_NAME, "form")
-    for form in forms:
-        if form.is_displayed():
-            return form
-    return None
+    # Один execute_script вместо is_displayed() на каждую форму.
+    return driver.execute_script(VISIBLE_FORM_JS)
 
 
 def fill_form_fields(form, overrides: Dict[str, Union[str, List[str]]]) -> List[str]:
@@ -431,6 +515,59 @@ def fill_form_fields(form, overrides: Dict[str, Union[str, List[str]]]) -> List[
     return missing
 
 
+BATCH_FILL_JS = """
+var form = arguments[0];
+var values = arguments[1];
+var truthy = ['1', 'true', 'yes', 'on'];
+var missing = [];
+var fallback = [];
+function fire(el) {
+    el.dispatchEvent(new Event('input', {bubbles: true}));
+    el.dispatchEvent(new Event('change', {bubbles: true}));
+}
+Object.keys(values).forEach(function (name) {
+    var el = form.querySelector('[name="' + CSS.escape(name) + '"]');
+    if (!el) { missing.push(name); return; }
+    var value = values[name];
+    var tag = el.tagName.toLowerCase();
+    var type = (el.getAttribute('type') || '').toLowerCase();
+    try {
+        if (tag === 'select') {
+            var options = Array.prototype.slice.call(el.options);
+            var option = options.find(function (o) { return o.value === value; })
+                || options.find(function (o) { return o.text.trim() === value; });
+            if (!option) { fallback.push(name); return; }
+            el.value = option.value;
+            fire(el);
+        } else if (tag === 'input' && (type === 'checkbox' || type === 'radio')) {
+            var shouldCheck = truthy.indexOf(value.toLowerCase()) !== -1;
+            if (el.checked !== shouldCheck) { el.click(); }
+        } else {
+            el.value = value;
+            fire(el);
+        }
+    } catch (e) {
+        fallback.push(name);
+    }
+});
+return [missing, fallback];
+"""
+
+
+def batch_fill_form_fields(form, overrides: Dict[str, Union[str, List[str]]]) -> List[str]:
+    # Все поля выставляются одним execute_script; то, что не удалось через JS
+    # (например, select без подходящей опции), дозаполняем через fill_form_fields.
+    values = {name: str(value) for name, value in overrides.items()}
+    try:
+        missing, fallback = form.parent.execute_script(BATCH_FILL_JS, form, values)
+    except Exception:  # pylint: disable=broad-except
+        return fill_form_fields(form, overrides)
+    missing = list(missing)
+    if fallback:
+        missing.extend(fill_form_fields(form, {name: overrides[name] for name in fallback}))
+    return missing
+
+
 def maybe_submit_form(form) -> None:
     try:
         button = form.find_element(By.CSS_SELECTOR, "button[type='submit']")
@@ -446,7 +583,7 @@ def main() -> None:
     cookies_path = Path(args.cookies).expanduser()
 
     driver = build_driver(args.browser, args.headless)
-    wait = WebDriverWait(driver, args.wait)
+    wait = WebDriverWait(driver, args.wait, poll_frequency=WAIT_POLL_FREQUENCY)
 
     try:
         if args.reuse_cookies:
@@ -470,15 +607,13 @@ def main() -> None:
 
         if args.race_id and args.coupon_type:
             select_coupon_type(driver, wait, args.race_id, args.coupon_type)
-            time.sleep(1)
 
             form = get_visible_form(driver)
             if not form:
                 raise RuntimeError("Не удалось найти форму создания промокода.")
 
-            soup = BeautifulSoup(driver.page_source, "html.parser")
             try:
-                form_info = parse_html_form(str(soup), driver.current_url)
+                form_info = parse_html_form(driver.page_source, driver.current_url)
             except RuntimeError:
                 form_info = None
 
@@ -498,15 +633,19 @@ def main() -> None:
             else:
                 payload = overrides
 
-            missing = fill_form_fields(form, payload)
+            missing = batch_fill_form_fields(form, payload)
             if missing:
                 print("Не удалось заполнить поля:", ", ".join(missing), file=sys.stderr)
 
             if args.dry_run:
                 print("Dry-run: форма не отправлена. Заполненные данные готовы к проверке.")
             else:
+                prev_url = driver.current_url
                 maybe_submit_form(form)
-                time.sleep(1)
+                try:
+                    wait.until(EC.url_changes(prev_url))
+                except TimeoutException:
+                    print("Адрес страницы не изменился после отправки формы.", file=sys.stderr)
                 print(f"Форма отправлена. Текущий URL: {driver.current_url}")
 
     except Exception as exc:  # pylint: disable=broad-except
@@ -8,22 +8,40 @@ import logging
 import os
 import signal
 import sys
+import threading
 import time
 from decimal import Decimal
 from http.cookiejar import MozillaCookieJar
 from pathlib import Path
-from typing import Dict, Iterable, List, MutableMapping, Optional, Tuple
+from typing import Any, Callable, Dict, Iterable, List, MutableMapping, Optional, Tuple
 
 import requests
+from urllib3.util.retry import Retry
+
+try:
+    import orjson  # type: ignore
+except ImportError:  # pragma: no cover
+    orjson = None
 
 from income_goals import get_income_goals_path, load_income_goals
-from race_metrics import RaceMetrics, fetch_race_metrics, format_money
+from race_metrics import RaceMetrics, build_session, fetch_many, format_money
 
 LOGGER = logging.getLogger("race_income_watcher")
 
 DEFAULT_INTERVAL = 300  # seconds
 DEFAULT_COOKIES = "cookies/myrace_cookies.txt"
 DEFAULT_STATE_PATH = "data/race_income_state.json"
+# Если менялся только updated_at, state-файл переписываем не чаще раза в час.
+STATE_BOOKKEEPING_INTERVAL = 3600  # seconds
+MAX_FETCH_WORKERS = 8
+
+# path -> ((st_mtime_ns, st_size), результат loader) для файлов, которые
+# перечитываются на каждой итерации, но меняются редко.
+_FILE_CACHE: Dict[Path, Tuple[Tuple[int, int], Any]] = {}
+
+# Общая сессия для Bot API: уведомления нескольким админам идут по одному
+# TLS-соединению с api.telegram.org.
+_TELEGRAM_SESSION = requests.Session()
 
 
 def _configure_logging() -> None:
@@ -41,6 +59,21 @@ def _load_cookies(path: Path) -> MozillaCookieJar:
     return jar
 
 
+def _cached_load(path: Path, loader: Callable[[Path], Any]) -> Any:
+    try:
+        stat = path.stat()
+    except FileNotFoundError:
+        _FILE_CACHE.pop(path, None)
+        return loader(path)
+    key = (stat.st_mtime_ns, stat.st_size)
+    cached = _FILE_CACHE.get(path)
+    if cached is not None and cached[0] == key:
+        return cached[1]
+    value = loader(path)
+    _FILE_CACHE[path] = (key, value)
+    return value
+
+
 def _parse_admin_ids(raw: str) -> List[int]:
     ids: List[int] = []
     for part in raw.split(","):
@@ -54,6 +87,28 @@ def _parse_admin_ids(raw: str) -> List[int]:
     return ids
 
 
+def _read_race_ids_file(store_path: Path) -> List[str]:
+    if not store_path.exists():
+        return []
+    try:
+        with store_path.open("r", encoding="utf-8") as handle:
+            payload = json.load(handle)
+    except json.JSONDecodeError as exc:
+        LOGGER.warning("Не удалось разобрать %s: %s", store_path, exc)
+        return []
+    collected: List[str] = []
+    if isinstance(payload, list):
+        for item in payload:
+            if isinstance(item, dict):
+                value = item.get("id") or item.get("race_id")
+            else:
+                value = None
+            if value is None:
+                continue
+            collected.append(str(value))
+    return collected
+
+
 def _load_race_ids() -> List[str]:
     explicit = os.getenv("MYRACE_WATCH_RACE_IDS", "").strip()
     if explicit:
@@ -62,25 +117,9 @@ def _load_race_ids() -> List[str]:
             return result
 
     store_path = Path(os.getenv("MYRACE_RACES_PATH", "races.json"))
-    if store_path.exists():
-        try:
-            with store_path.open("r", encoding="utf-8") as handle:
-                payload = json.load(handle)
-        except json.JSONDecodeError as exc:
-            LOGGER.warning("Не удалось разобрать %s: %s", store_path, exc)
-        else:
-            collected: List[str] = []
-            if isinstance(payload, list):
-                for item in payload:
-                    if isinstance(item, dict):
-                        value = item.get("id") or item.get("race_id")
-                    else:
-                        value = None
-                    if value is None:
-                        continue
-                    collected.append(str(value))
-            if collected:
-                return collected
+    collected = _cached_load(store_path, _read_race_ids_file)
+    if collected:
+        return list(collected)
 
     env_default = os.getenv("MYRACE_RACE_ID", "1440").strip()
     if env_default:
@@ -92,8 +131,11 @@ def _read_state(path: Path) -> Dict[str, Dict[str, str]]:
     if not path.exists():
         return {}
     try:
-        with path.open("r", encoding="utf-8") as handle:
-            data = json.load(handle)
+        if orjson is not None:
+            data = orjson.loads(path.read_bytes())
+        else:
+            with path.open("r", encoding="utf-8") as handle:
+                data = json.load(handle)
     except (json.JSONDecodeError, OSError) as exc:
         LOGGER.warning("Не удалось прочитать состояние из %s: %s", path, exc)
         return {}
@@ -106,20 +148,20 @@ def _read_state(path: Path) -> Dict[str, Dict[str, str]]:
 def _write_state(path: Path, state: MutableMapping[str, Dict[str, str]]) -> None:
     path.parent.mkdir(parents=True, exist_ok=True)
     tmp_path = path.with_suffix(path.suffix + ".tmp")
-    with tmp_path.open("w", encoding="utf-8") as handle:
-        json.dump(state, handle, ensure_ascii=False, indent=2, sort_keys=True)
+    if orjson is not None:
+        tmp_path.write_bytes(orjson.dumps(state, option=orjson.OPT_INDENT_2 | orjson.OPT_SORT_KEYS))
+    else:
+        with tmp_path.open("w", encoding="utf-8") as handle:
+            json.dump(state, handle, ensure_ascii=False, indent=2, sort_keys=True)
     tmp_path.replace(path)
 
 
 def _build_session(cookies_path: Path) -> requests.Session:
-    session = requests.Session()
-    session.headers.update(
-        {
-            "User-Agent": "Mozilla/5.0 (X11; Linux x86_64) MyRaceHelperBot/1.0",
-            "Accept-Language": "ru-RU,ru;q=0.9,en-US;q=0.8,en;q=0.7",
-        }
-    )
-    session.cookies = _load_cookies(cookies_path)
+    # Пул под параллельные запросы метрик. Адаптер повторяет только сбои
+    # соединения; 429/5xx повторяет fetch_race_metrics (RETRY_STATUSES).
+    retry = Retry(total=3, status=0, backoff_factor=0.3, allowed_methods=("GET", "HEAD"))
+    session = build_session(pool_maxsize=MAX_FETCH_WORKERS, max_retries=retry)
+    session.cookies = _cached_load(cookies_path, _load_cookies)
     return session
 
 
@@ -131,7 +173,7 @@ def _send_notification(
     api_url = f"https://api.telegram.org/bot{bot_token}/sendMessage"
     for chat_id in admin_ids:
         try:
-            response = requests.post(
+            response = _TELEGRAM_SESSION.post(
                 api_url,
                 json={"chat_id": chat_id, "text": message, "parse_mode": "HTML", "disable_web_page_preview": True},
                 timeout=30,
@@ -146,14 +188,18 @@ def _build_message(
     current: Decimal,
     metrics: RaceMetrics,
     target: Optional[Decimal] = None,
+    previous_text: Optional[str] = None,
+    current_text: Optional[str] = None,
 ) -> str:
     delta = current - previous
     direction = "⬆️" if delta > 0 else "⬇️"
     delta_text = format_money(delta.copy_abs())
     if delta == 0:
         direction = "➖"
-    previous_text = format_money(previous)
-    current_text = format_money(current)
+    if previous_text is None:
+        previous_text = format_money(previous)
+    if current_text is None:
+        current_text = format_money(current)
     lines = [
         f"💰 Доход изменился для гонки <b>{metrics.title}</b> (ID {metrics.race_id}).",
         f"{direction} Было: {previous_text} → Стало: {current_text} ₽ (Δ {delta_text}).",
@@ -191,37 +237,47 @@ def run_monitor() -> None:
     cookies_path = Path(os.getenv("MYRACE_COOKIES_PATH", DEFAULT_COOKIES)).expanduser()
     state_path = Path(os.getenv("MYRACE_WATCH_STATE_PATH", DEFAULT_STATE_PATH)).expanduser()
     state = _read_state(state_path)
+    # Decimal-копия выручки из state, чтобы не разбирать строку на каждом тике.
+    revenue_cache: Dict[str, Decimal] = {
+        race_id: Decimal(entry.get("revenue", "0")) for race_id, entry in state.items()
+    }
     goals_path = get_income_goals_path()
     LOGGER.info("Запускаем мониторинг каждые %s секунд.", interval)
 
-    stop_requested = False
+    # Event вместо флага: ожидание между итерациями прерывается сразу по сигналу.
+    stop_event = threading.Event()
 
     def _handle_signal(signum: int, _frame) -> None:  # type: ignore[override]
+        if stop_event.is_set():
+            return
         LOGGER.info("Получен сигнал %s, завершаем после текущей итерации.", signum)
-        nonlocal stop_requested
-        stop_requested = True
+        stop_event.set()
 
     signal.signal(signal.SIGINT, _handle_signal)
     signal.signal(signal.SIGTERM, _handle_signal)
 
     session = _build_session(cookies_path)
     last_reported_ids: Optional[Tuple[str, ...]] = None
+    last_persist = time.monotonic()
 
     while True:
         start_ts = time.monotonic()
+        now_text = str(int(time.time()))
         try:
-            session.cookies = _load_cookies(cookies_path)
+            # Пока файл не менялся, оставляем тот же jar (вместе с cookies,
+            # которые сервер мог обновить по ходу запросов).
+            session.cookies = _cached_load(cookies_path, _load_cookies)
         except FileNotFoundError as exc:
             LOGGER.error("%s", exc)
-            time.sleep(interval)
+            if stop_event.wait(interval):
+                break
             continue
 
         race_ids = _load_race_ids()
         if not race_ids:
             LOGGER.error("Не найден список гонок (MYRACE_WATCH_RACE_IDS / races.json / MYRACE_RACE_ID). Ждём и пробуем снова.")
-            if stop_requested:
+            if stop_event.wait(interval):
                 break
-            time.sleep(interval)
             continue
         race_ids_tuple = tuple(race_ids)
         if race_ids_tuple != last_reported_ids:
@@ -229,58 +285,71 @@ def run_monitor() -> None:
             last_reported_ids = race_ids_tuple
 
         income_goals = load_income_goals(goals_path)
-        state_changed = False
-        for race_id in race_ids:
-            try:
-                metrics = fetch_race_metrics(session, race_id)
-            except Exception as exc:  # pylint: disable=broad-except
-                LOGGER.error("Не удалось обновить гонку %s: %s", race_id, exc)
+        content_changed = False
+        bookkeeping_changed = False
+        # Результаты приходят в порядке race_ids, поэтому уведомления и логи
+        # идут так же, как при последовательном опросе.
+        for race_id, result in fetch_many(session, race_ids, workers=MAX_FETCH_WORKERS):
+            if isinstance(result, Exception):
+                LOGGER.error("Не удалось обновить гонку %s: %s", race_id, result)
                 continue
+            metrics = result
             previous_entry = state.get(race_id)
-            current_value = str(metrics.revenue)
             if not previous_entry:
                 LOGGER.info("Добавляем в наблюдение гонку %s с доходом %s ₽.", race_id, format_money(metrics.revenue))
                 state[race_id] = {
-                    "revenue": current_value,
+                    "revenue": str(metrics.revenue),
                     "participants": str(metrics.participants),
-                    "updated_at": str(int(time.time())),
+                    "updated_at": now_text,
                 }
-                state_changed = True
+                revenue_cache[race_id] = metrics.revenue
+                content_changed = True
                 continue
-            previous_revenue = Decimal(previous_entry.get("revenue", "0"))
+            previous_revenue = revenue_cache[race_id]
             if metrics.revenue == previous_revenue:
                 # Обновляем вспомогательные показатели для истории.
-                previous_entry["participants"] = str(metrics.participants)
-                previous_entry["updated_at"] = str(int(time.time()))
-                state_changed = True
+                participants = str(metrics.participants)
+                if previous_entry.get("participants") != participants:
+                    previous_entry["participants"] = participants
+                    content_changed = True
+                previous_entry["updated_at"] = now_text
+                bookkeeping_changed = True
                 continue
             target_income = income_goals.get(race_id)
-            message = _build_message(previous_revenue, metrics.revenue, metrics, target=target_income)
-            LOGGER.info(
-                "Доход гонки %s изменился: %s ₽ -> %s ₽.",
-                race_id,
-                format_money(previous_revenue),
-                format_money(metrics.revenue),
+            previous_text = format_money(previous_revenue)
+            current_text = format_money(metrics.revenue)
+            message = _build_message(
+                previous_revenue,
+                metrics.revenue,
+                metrics,
+                target=target_income,
+                previous_text=previous_text,
+                current_text=current_text,
             )
+            LOGGER.info("Доход гонки %s изменился: %s ₽ -> %s ₽.", race_id, previous_text, current_text)
             _send_notification(bot_token, admin_ids, message)
             state[race_id] = {
-                "revenue": current_value,
+                "revenue": str(metrics.revenue),
                 "participants": str(metrics.participants),
-                "updated_at": str(int(time.time())),
+                "updated_at": now_text,
             }
-            state_changed = True
+            revenue_cache[race_id] = metrics.revenue
+            content_changed = True
 
-        if state_changed:
+        persist_due = time.monotonic() - last_persist >= STATE_BOOKKEEPING_INTERVAL
+        if content_changed or (bookkeeping_changed and persist_due):
             try:
                 _write_state(state_path, state)
+                last_persist = time.monotonic()
             except Exception as exc:  # pylint: disable=broad-except
                 LOGGER.error("Не удалось записать состояние %s: %s", state_path, exc)
 
-        if stop_requested:
+        if stop_event.is_set():
             break
         elapsed = time.monotonic() - start_ts
         sleep_for = max(1.0, interval - elapsed)
-        time.sleep(sleep_for)
+        if stop_event.wait(sleep_for):
+            break
 
 
 if __name__ == "__main__":
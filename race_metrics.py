@@ -3,18 +3,58 @@
 
 from __future__ import annotations
 
+import codecs
+import random
+import re
+import threading
 import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
 from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
-from typing import Iterable, List, Optional, Tuple
+from typing import Dict, Iterable, List, Optional, Tuple, Union
 
 import requests
-from bs4 import BeautifulSoup  # type: ignore
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from lxml import etree  # type: ignore
 
 SUMMARY_URL = "https://myrace.info/entities/races/{race_id}"
 HOME_URL = "https://myrace.info/"
 DEFAULT_FETCH_RETRIES = 3
 RETRY_DELAY = 1.0
+RETRY_DELAY_CAP = 30.0
+RETRY_JITTER = 0.5
+# Временные ошибки сервера повторяет сам fetch_race_metrics; адаптер сессии
+# повторяет только сбои соединения, иначе попытки перемножаются.
+RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
+DEFAULT_FETCH_WORKERS = 8
+SESSION_POOL_CONNECTIONS = 10
+SESSION_POOL_MAXSIZE = 20
+SESSION_HEADERS = {
+    "User-Agent": "Mozilla/5.0 (X11; Linux x86_64) MyRaceHelperBot/1.0",
+    "Accept-Language": "ru-RU,ru;q=0.9,en-US;q=0.8,en;q=0.7",
+    "Connection": "keep-alive",
+    # DEFAULT_ACCEPT_ENCODING включает br только если установлен brotli,
+    # поэтому сервер не пришлёт ответ, который urllib3 не сможет распаковать.
+    "Accept-Encoding": requests.utils.DEFAULT_ACCEPT_ENCODING,
+}
+
+SUMMARY_CHUNK_SIZE = 16384
+NON_DIGITS_RE = re.compile(r"\D+")
+NUMBER_JUNK_RE = re.compile(r"[^\d.\-]+")
+NUMBER_TRANSLATION = str.maketrans({",": "."})
+CENTS = Decimal("0.01")
+META_CHARSET_RE = re.compile(rb"<meta[^>]+charset=[\"']?([\w.:-]+)", re.IGNORECASE)
+# /account/login тоже содержит /login, отдельная проверка не нужна.
+LOGIN_URL_RE = re.compile(r"/login", re.IGNORECASE)
+CHARSET_RE = re.compile(r"charset=[\"']?([\w.:-]+)", re.IGNORECASE)
+
+# race_id -> (ETag, Last-Modified, метрики) последнего полного ответа. Если сервер
+# отдаёт валидаторы, повторный опрос с 304 обходится без загрузки и разбора страницы.
+METRICS_CACHE_SIZE = 128
+_METRICS_CACHE: "OrderedDict[str, Tuple[Optional[str], Optional[str], RaceMetrics]]" = OrderedDict()
+_METRICS_CACHE_LOCK = threading.Lock()
 
 
 @dataclass
@@ -26,9 +66,8 @@ class RaceMetrics:
 
 
 def _normalize_number(value: str) -> str:
-    normalized = value.replace("\xa0", " ").replace(",", ".")
-    allowed = "".join(ch for ch in normalized if ch.isdigit() or ch in ".- ")
-    return allowed.replace(" ", "")
+    # Пробелы (в том числе неразрывные) и валюта уходят одной заменой.
+    return NUMBER_JUNK_RE.sub("", value.translate(NUMBER_TRANSLATION))
 
 
 def _parse_revenue(value: str) -> Decimal:
@@ -39,48 +78,228 @@ def _parse_revenue(value: str) -> Decimal:
         amount = Decimal(candidate)
     except InvalidOperation as exc:  # pragma: no cover
         raise ValueError(f"Некорректный формат дохода: {value}") from exc
-    return amount.quantize(Decimal("0.01"), rounding=ROUND_HALF_UP)
+    return amount.quantize(CENTS, rounding=ROUND_HALF_UP)
 
 
 def _parse_participants(value: str) -> int:
-    digits = "".join(ch for ch in value if ch.isdigit())
+    digits = NON_DIGITS_RE.sub("", value)
     if not digits:
         raise ValueError(f"Не удалось извлечь число участников из '{value}'.")
     return int(digits)
 
 
-def _collect_stat_pairs(soup: BeautifulSoup) -> List[Tuple[str, str]]:
-    pairs: List[Tuple[str, str]] = []
-    for item in soup.select("div.list-item"):
-        cells = item.find_all("div", recursive=False)
-        if len(cells) < 2:
-            continue
-        label = cells[0].get_text(strip=True)
-        value = cells[1].get_text(strip=True)
-        if not label or not value:
-            continue
-        pairs.append((label, value))
-    return pairs
+def _collapse(parts: List[str]) -> str:
+    return " ".join("".join(parts).split())
+
+
+class _SummaryTarget:
+    # Target-парсер для lxml: дерево не строится, по событиям start/data/end
+    # собираем только блоки div.list-item (первые два дочерних div), заголовок
+    # из .card h2 и первый h1 как запасной.
+
+    def __init__(self) -> None:
+        self.depth = 0
+        self.item_depth: Optional[int] = None
+        self.cells: List[List[str]] = []
+        self.cell_depth: Optional[int] = None
+        self.card_depths: List[int] = []
+        self.title_depth: Optional[int] = None
+        self.title_parts: List[str] = []
+        self.title_in_card = False
+        self.card_title: Optional[str] = None
+        self.heading: Optional[str] = None
+        self.participants: Optional[str] = None
+        self.income: Optional[str] = None
+
+    @property
+    def done(self) -> bool:
+        return self.participants is not None and self.income is not None and self.card_title is not None
+
+    def start(self, tag: str, attrib: Dict[str, str]) -> None:
+        self.depth += 1
+        classes = (attrib.get("class") or "").split()
+        if "card" in classes:
+            self.card_depths.append(self.depth)
+        if tag == "div":
+            if self.item_depth is None and "list-item" in classes:
+                self.item_depth = self.depth
+                self.cells = []
+            elif self.item_depth is not None and self.depth == self.item_depth + 1 and len(self.cells) < 2:
+                # Нужны только подпись и значение; дальнейшие колонки не собираем.
+                self.cells.append([])
+                self.cell_depth = self.depth
+        if self.title_depth is None:
+            if tag == "h2" and self.card_depths and self.card_title is None:
+                self.title_depth = self.depth
+                self.title_in_card = True
+                self.title_parts = []
+            elif tag == "h1" and self.heading is None:
+                self.title_depth = self.depth
+                self.title_in_card = False
+                self.title_parts = []
 
+    def data(self, data: str) -> None:
+        if self.cell_depth is not None:
+            self.cells[-1].append(data)
+        if self.title_depth is not None:
+            self.title_parts.append(data)
 
-def _extract_metric(pairs: Iterable[Tuple[str, str]], keyword: str) -> Optional[str]:
-    for label, value in pairs:
-        if keyword in label.lower():
-            return value
-    return None
+    def end(self, _tag: str) -> None:
+        depth = self.depth
+        if self.title_depth == depth:
+            text = _collapse(self.title_parts)
+            if self.title_in_card:
+                self.card_title = text
+            else:
+                self.heading = text
+            self.title_depth = None
+        if self.cell_depth == depth:
+            self.cell_depth = None
+        if self.item_depth == depth:
+            self._finish_item()
+            self.item_depth = None
+        if self.card_depths and self.card_depths[-1] == depth:
+            self.card_depths.pop()
+        self.depth -= 1
+
+    def _finish_item(self) -> None:
+        # Берём первые «участ…» и «доход…» с непустыми значениями.
+        if len(self.cells) < 2:
+            return
+        label = _collapse(self.cells[0]).lower()
+        if not label:
+            return
+        wants_participants = self.participants is None and "участ" in label
+        wants_income = self.income is None and "доход" in label
+        if not wants_participants and not wants_income:
+            return
+        value = _collapse(self.cells[1])
+        if not value:
+            return
+        if wants_participants:
+            self.participants = value
+        if wants_income:
+            self.income = value
+
+    def close(self) -> "_SummaryTarget":
+        return self
+
+
+def _parse_summary(response: requests.Response) -> _SummaryTarget:
+    # Страница читается потоком; как только найдены обе метрики и заголовок
+    # карточки, парсер больше не кормим, а остаток только дочитываем, чтобы
+    # соединение вернулось в пул. Парсер на каждый вызов: его нельзя делить между потоками.
+    target = _SummaryTarget()
+    parser: Optional[etree.HTMLParser] = None
+    for chunk in response.iter_content(chunk_size=SUMMARY_CHUNK_SIZE):
+        if not chunk or target.done:
+            continue
+        if parser is None:
+            encoding = _declared_charset(response, chunk)
+            parser = etree.HTMLParser(target=target, encoding=encoding)
+        parser.feed(chunk)
+    if parser is None:
+        return target
+    try:
+        parser.close()
+    except etree.XMLSyntaxError:
+        # Пустой ответ: блоков нет, это сообщит вызывающий код.
+        pass
+    return target
 
 
 def format_money(value: Decimal) -> str:
-    quantized = value.quantize(Decimal("0.01"), rounding=ROUND_HALF_UP)
+    quantized = value.quantize(CENTS, rounding=ROUND_HALF_UP)
     text = f"{quantized:,.2f}".replace(",", " ")
     if text.endswith(".00"):
         text = text[:-3]
     return text
 
 
+def build_session(
+    pool_maxsize: int = SESSION_POOL_MAXSIZE,
+    max_retries: Union[int, Retry] = 0,
+) -> requests.Session:
+    # Сессия для fetch_race_metrics: соединения с myrace.info переиспользуются
+    # между гонками и потоками. Cookies подставляет вызывающий код.
+    session = requests.Session()
+    session.headers.update(SESSION_HEADERS)
+    adapter = HTTPAdapter(
+        pool_connections=SESSION_POOL_CONNECTIONS,
+        pool_maxsize=pool_maxsize,
+        max_retries=max_retries,
+    )
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+_CacheEntry = Tuple[Optional[str], Optional[str], RaceMetrics]
+
+
+def _cached_entry(race_id: str) -> Optional[_CacheEntry]:
+    # Снимок записи берём один раз на запрос: по нему строятся условные заголовки
+    # и из него же отдаются метрики на 304, даже если LRU успел её вытеснить.
+    with _METRICS_CACHE_LOCK:
+        cached = _METRICS_CACHE.get(race_id)
+        if cached is not None:
+            _METRICS_CACHE.move_to_end(race_id)
+        return cached
+
+
+def _conditional_headers(cached: Optional[_CacheEntry]) -> Dict[str, str]:
+    headers: Dict[str, str] = {}
+    if cached is None:
+        return headers
+    etag, last_modified, _metrics = cached
+    if etag:
+        headers["If-None-Match"] = etag
+    if last_modified:
+        headers["If-Modified-Since"] = last_modified
+    return headers
+
+
+def _remember_metrics(race_id: str, response: requests.Response, metrics: RaceMetrics) -> None:
+    etag = response.headers.get("ETag")
+    last_modified = response.headers.get("Last-Modified")
+    with _METRICS_CACHE_LOCK:
+        if not etag and not last_modified:
+            _METRICS_CACHE.pop(race_id, None)
+            return
+        _METRICS_CACHE[race_id] = (etag, last_modified, metrics)
+        _METRICS_CACHE.move_to_end(race_id)
+        while len(_METRICS_CACHE) > METRICS_CACHE_SIZE:
+            _METRICS_CACHE.popitem(last=False)
+
+
+def _declared_charset(response: requests.Response, head: bytes) -> str:
+    # response.encoding подставляет ISO-8859-1 для text/* без charset, поэтому
+    # смотрим сначала Content-Type, потом <meta charset> в начале страницы,
+    # а без объявления (или с неизвестной кодировкой) считаем страницу UTF-8.
+    match = CHARSET_RE.search(response.headers.get("Content-Type", ""))
+    if match:
+        label = match.group(1)
+    else:
+        meta = META_CHARSET_RE.search(head)
+        if not meta:
+            return "utf-8"
+        label = meta.group(1).decode("ascii")
+    try:
+        return codecs.lookup(label).name
+    except LookupError:
+        return "utf-8"
+
+
+def _retry_pause(attempt: int, retry_delay: float, retries: int) -> None:
+    # Экспоненциальная пауза с джиттером; после последней попытки не ждём.
+    if attempt + 1 >= retries:
+        return
+    delay = retry_delay * (2 ** attempt) * (1 + random.uniform(0, RETRY_JITTER))
+    time.sleep(min(RETRY_DELAY_CAP, delay))
+
+
 def _looks_like_login(resp: requests.Response) -> bool:
-    candidate_url = resp.url.lower()
-    return "/login" in candidate_url or "/account/login" in candidate_url
+    return LOGIN_URL_RE.search(resp.url) is not None
 
 
 def fetch_race_metrics(
@@ -92,39 +311,76 @@ def fetch_race_metrics(
     url = SUMMARY_URL.format(race_id=race_id)
     expected_url = url.split("?", 1)[0].rstrip("/")
     last_error: Optional[str] = None
+    home_refreshed = False
+    conditional = True
 
     for attempt in range(retries):
-        response = session.get(url, timeout=60)
-        response.raise_for_status()
-        final_url = response.url.split("?", 1)[0].rstrip("/")
-
-        login_redirect = any(_looks_like_login(prev) for prev in response.history) or _looks_like_login(response)
-        if login_redirect:
-            last_error = "Получена страница входа. Проверьте cookie-файл."
-            try:
-                session.get(HOME_URL, timeout=30)
-            except Exception:
-                pass
-            time.sleep(retry_delay)
-            continue
+        cached = _cached_entry(race_id) if conditional else None
+        with session.get(url, headers=_conditional_headers(cached), timeout=60, stream=True) as response:
+            if response.status_code == 304:
+                if cached is not None:
+                    return cached[2]
+                # 304 без снимка в кэше: тела нет, запрашиваем страницу заново без условий.
+                last_error = "Сервер ответил 304 на безусловный запрос."
+                conditional = False
+                continue
+            if response.status_code in RETRY_STATUSES and attempt + 1 < retries:
+                _retry_pause(attempt, retry_delay, retries)
+                continue
+            response.raise_for_status()
+            final_url = response.url.split("?", 1)[0].rstrip("/")
 
-        if final_url != expected_url:
-            last_error = (
-                f"Ожидался URL {expected_url}, а пришёл {final_url}. Возможно, сессия истекла или нет доступа."
-            )
-            time.sleep(retry_delay)
-            continue
+            # Чаще всего на логин указывает сам конечный ответ — проверяем его первым.
+            login_redirect = _looks_like_login(response) or any(_looks_like_login(prev) for prev in response.history)
+            if login_redirect:
+                last_error = "Получена страница входа. Проверьте cookie-файл."
+                # Главную дёргаем один раз, чтобы сервер обновил cookies; повторять
+                # этот запрос на каждой попытке смысла нет.
+                if not home_refreshed:
+                    home_refreshed = True
+                    try:
+                        session.get(HOME_URL, timeout=30)
+                    except Exception:
+                        pass
+                _retry_pause(attempt, retry_delay, retries)
+                continue
 
-        soup = BeautifulSoup(response.text, "html.parser")
-        pairs = _collect_stat_pairs(soup)
-        participants_raw = _extract_metric(pairs, "участ")
-        income_raw = _extract_metric(pairs, "доход")
-        if not participants_raw or not income_raw:
+            if final_url != expected_url:
+                last_error = (
+                    f"Ожидался URL {expected_url}, а пришёл {final_url}. Возможно, сессия истекла или нет доступа."
+                )
+                _retry_pause(attempt, retry_delay, retries)
+                continue
+
+            summary = _parse_summary(response)
+        if not summary.participants or not summary.income:
             raise RuntimeError("Не удалось найти блоки с участниками или доходом.")
-        participants = _parse_participants(participants_raw)
-        revenue = _parse_revenue(income_raw)
-        title_tag = soup.select_one(".card h2") or soup.select_one("h1")
-        title = title_tag.get_text(strip=True) if title_tag else f"Гонка {race_id}"
-        return RaceMetrics(race_id=race_id, title=title, participants=participants, revenue=revenue)
+        participants = _parse_participants(summary.participants)
+        revenue = _parse_revenue(summary.income)
+        title = summary.card_title or summary.heading or f"Гонка {race_id}"
+        metrics = RaceMetrics(race_id=race_id, title=title, participants=participants, revenue=revenue)
+        _remember_metrics(race_id, response, metrics)
+        return metrics
 
     raise RuntimeError(last_error or "Не удалось получить страницу гонки после повторных попыток.")
+
+
+def fetch_many(
+    session: requests.Session,
+    race_ids: Iterable[str],
+    workers: int = DEFAULT_FETCH_WORKERS,
+) -> List[Tuple[str, Union[RaceMetrics, Exception]]]:
+    # Гонки запрашиваются параллельно через общую сессию; результат идёт в
+    # порядке race_ids, а ошибка одной гонки возвращается вместо её метрик.
+    ids = list(race_ids)
+    if not ids:
+        return []
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(ids)))) as executor:
+        futures = [executor.submit(fetch_race_metrics, session, race_id) for race_id in ids]
+    results: List[Tuple[str, Union[RaceMetrics, Exception]]] = []
+    for race_id, future in zip(ids, futures):
+        try:
+            results.append((race_id, future.result()))
+        except Exception as exc:  # pylint: disable=broad-except
+            results.append((race_id, exc))
+    return results
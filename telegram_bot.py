@@ -4,12 +4,14 @@
 from __future__ import annotations
 
 import asyncio
+import functools
 import json
 import logging
 import os
 import re
 import shlex
 import sys
+import threading
 import time
 # pylint: disable=too-many-lines
 
@@ -18,19 +20,28 @@ from dataclasses import dataclass
 from decimal import Decimal
 from http.cookiejar import MozillaCookieJar
 from pathlib import Path
-from typing import Callable, Iterable, List, Optional, Tuple
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional, Tuple, TypeVar, Union
 from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import groupby
+from operator import attrgetter
 from urllib.parse import urljoin
 
 import requests
-from bs4 import BeautifulSoup  # type: ignore
+from bs4 import BeautifulSoup, SoupStrainer  # type: ignore
+from urllib3.util.retry import Retry
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update
 from telegram.constants import ParseMode
 from telegram.ext import (Application, ApplicationBuilder, CallbackQueryHandler,
                           CommandHandler, ContextTypes, MessageHandler, filters)
 
 from income_goals import get_income_goals_path, load_income_goals, upsert_income_goal
-from race_metrics import RaceMetrics, fetch_race_metrics, format_money
+from race_metrics import RaceMetrics, build_session, fetch_race_metrics, format_money
+
+try:
+    import orjson  # type: ignore
+except ImportError:  # pragma: no cover
+    orjson = None
 
 try:  # Work around python-telegram-bot 20.x bug on Python 3.13
     from telegram.ext._updater import Updater as _PTBUpdater  # type: ignore
@@ -51,6 +62,31 @@ DEFAULT_USAGE_LIMIT = int(os.getenv("MYRACE_USAGE_LIMIT", "1"))
 DEFAULT_STEP_DELAY = os.getenv("MYRACE_STEP_DELAY")
 
 COOKIES_PATH = os.getenv("MYRACE_COOKIES_PATH", "cookies/myrace_cookies.txt")
+SHARED_SESSION_POOL_SIZE = 16
+TITLE_FETCH_WORKERS = 8
+# Для списка гонок нужны только ссылки, для страницы гонки — только заголовок.
+RACE_LINKS_STRAINER = SoupStrainer("a", href=True)
+RACE_TITLE_STRAINER = SoupStrainer(["h1", "title"])
+INPUT_STRAINER = SoupStrainer("input")
+# Покрывает и /entities/races/<id>: эта ссылка тоже содержит /races/<id>.
+RACE_HREF_RE = re.compile(r"/races/(\d+)")
+RACE_ID_RE = re.compile(r"(\d+)")
+INT_RE = re.compile(r"-?\d+")
+DIGIT_RE = re.compile(r"\d")
+PROMO_CODE_RE = re.compile(r"[A-Z0-9-]{4,16}")
+PROMO_VIEW_ID_RE = re.compile(r"/promo/view/(\d+)")
+PROMO_VIEW_PATH_RE = re.compile(r"/promo/view/\d+(?:\?[^\s\"'>]*)?")
+VIEW_URL_DQ_RE = re.compile(r'"(?:viewUrl|view_url)"\s*:\s*"([^"]+)"')
+VIEW_URL_SQ_RE = re.compile(r"'(?:viewUrl|view_url)'\s*:\s*'([^']+)'")
+PROMO_VIEW_URL_JS_RE = re.compile(r"promoViewUrl\s*=\s*['\"]([^'\"]+)['\"]")
+HX_ATTRS = ("hx-get", "hx-post", "data-hx-get", "data-hx-post")
+RACES_CACHE_TTL = 60.0  # seconds
+RACE_TITLE_TTL = 3600.0  # seconds
+PROGRESS_UPDATE_INTERVAL = 0.5  # seconds
+ACTUAL_CODE_MARKER = b"ACTUAL_CODE:"
+SUBPROCESS_LINE_LIMIT = 1 << 20  # bytes
+# Лимит Telegram — 4096 символов; оставляем запас на HTML-сущности.
+TELEGRAM_CHUNK_LIMIT = 3800
 RACES_STORE_PATH = Path(os.getenv("MYRACE_RACES_PATH", "races.json"))
 MAX_RACE_BUTTONS = int(os.getenv("MYRACE_RACE_BUTTONS", "12"))
 MAX_PROMO_PAGES = int(os.getenv("MYRACE_MAX_PAGES", "30"))
@@ -73,11 +109,11 @@ HX_HEADERS = {
     "X-Requested-With": "XMLHttpRequest",
 }
 _admin_env = os.getenv("TELEGRAM_ADMIN_IDS", "").strip()
-ADMIN_IDS = {
+ADMIN_IDS = frozenset(
     int(part)
     for part in _admin_env.split(",")
     if part.strip().lstrip("-").isdigit()
-}
+)
 
 _log_level_name = os.getenv("LOG_LEVEL", "INFO").upper()
 _log_level = getattr(logging, _log_level_name, logging.INFO)
@@ -132,16 +168,83 @@ def _build_command(
     return cmd
 
 
-async def _run_command(cmd: List[str]) -> tuple[int, str, str]:
+async def _read_stream(
+    stream: asyncio.StreamReader,
+    sink: List[bytes],
+    on_line: Optional[Callable[[bytes], Awaitable[None]]] = None,
+) -> None:
+    while True:
+        try:
+            line = await stream.readuntil(b"\n")
+        except asyncio.IncompleteReadError as exc:
+            line = exc.partial
+        except asyncio.LimitOverrunError:
+            # Строка длиннее SUBPROCESS_LINE_LIMIT: остаток забираем целиком,
+            # как это делал communicate(), уже без построчной обработки.
+            sink.append(await stream.read())
+            return
+        if not line:
+            return
+        sink.append(line)
+        if on_line is not None:
+            await on_line(line)
+
+
+async def _run_command(
+    cmd: List[str],
+    on_stdout_line: Optional[Callable[[bytes], Awaitable[None]]] = None,
+) -> tuple[int, bytes, bytes]:
     process = await asyncio.create_subprocess_exec(
         *cmd,
         stdout=asyncio.subprocess.PIPE,
         stderr=asyncio.subprocess.PIPE,
+        limit=SUBPROCESS_LINE_LIMIT,
     )
-    stdout_bytes, stderr_bytes = await process.communicate()
-    stdout = stdout_bytes.decode("utf-8", "ignore")
-    stderr = stderr_bytes.decode("utf-8", "ignore")
-    return process.returncode, stdout, stderr
+    # Читаем оба канала построчно по мере вывода: обработчик видит строки
+    # сразу, а не только после завершения процесса.
+    stdout_chunks: List[bytes] = []
+    stderr_chunks: List[bytes] = []
+    try:
+        await asyncio.gather(
+            _read_stream(process.stdout, stdout_chunks, on_stdout_line),
+            _read_stream(process.stderr, stderr_chunks),
+        )
+        returncode = await process.wait()
+    finally:
+        # При ошибке или отмене чтения не оставляем дочерний процесс без присмотра.
+        if process.returncode is None:
+            try:
+                process.kill()
+            except ProcessLookupError:
+                pass
+            await process.wait()
+    return returncode, b"".join(stdout_chunks), b"".join(stderr_chunks)
+
+
+def _parse_promo_stdout(stdout_bytes: bytes) -> tuple[Optional[str], str]:
+    # Декодирование и разбор вывода выполняются в потоке, а не в event loop.
+    # Маркер ищем одним проходом по байтам, без разбиения вывода на строки.
+    idx = stdout_bytes.rfind(b"\n" + ACTUAL_CODE_MARKER)
+    if idx != -1:
+        idx += 1
+    elif stdout_bytes.startswith(ACTUAL_CODE_MARKER):
+        idx = 0
+    else:
+        return None, stdout_bytes.decode("utf-8", "ignore").strip()
+    end = stdout_bytes.find(b"\n", idx)
+    code_end = end if end != -1 else len(stdout_bytes)
+    actual_code = stdout_bytes[idx + len(ACTUAL_CODE_MARKER):code_end].decode("utf-8", "ignore").strip()
+    rest = stdout_bytes[:idx]
+    if end != -1:
+        rest += stdout_bytes[end + 1:]
+    return actual_code or None, rest.decode("utf-8", "ignore").strip()
+
+
+def _format_command_error(stdout_bytes: bytes, stderr_bytes: bytes) -> str:
+    stderr = stderr_bytes.decode("utf-8", "ignore").strip()
+    if stderr:
+        return stderr
+    return stdout_bytes.decode("utf-8", "ignore").strip() or "Неизвестная ошибка"
 
 
 def _current_race_id(context: ContextTypes.DEFAULT_TYPE) -> str:
@@ -149,6 +252,38 @@ def _current_race_id(context: ContextTypes.DEFAULT_TYPE) -> str:
     return str(value)
 
 
+def admin_only(action: str):
+    # Проверка прав до входа в обработчик; action попадает в лог отказа.
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE, *args, **kwargs):
+            user = update.effective_user
+            user_id = user.id if user else None
+            if ADMIN_IDS and user_id not in ADMIN_IDS:
+                message = update.effective_message
+                if message:
+                    await message.reply_text("⛔️ пошел на хуй пидарас")
+                logger.warning("User %s attempted to %s without permissions", user_id, action)
+                return None
+            return await func(update, context, *args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+async def _reply_promo_created(message, output: str, actual_code: str) -> None:
+    if not message:
+        return
+    if output:
+        await message.reply_text(output)
+    await message.reply_text(
+        f"🎉 Промокод создан: <code>{escape(actual_code)}</code>",
+        parse_mode=ParseMode.HTML,
+    )
+
+
+@admin_only("create promo")
 async def _handle_create(
     update: Update,
     context: ContextTypes.DEFAULT_TYPE,
@@ -157,14 +292,6 @@ async def _handle_create(
     usage_limit: int,
     slot_value: Optional[str] = None,
 ) -> None:
-    user = update.effective_user
-    user_id = user.id if user else None
-    if ADMIN_IDS and user_id not in ADMIN_IDS:
-        message = update.effective_message
-        if message:
-            await message.reply_text("⛔️ пошел на хуй пидарас")
-        logger.warning("User %s attempted to create promo without permissions", user_id)
-        return
     cookies_file = Path(COOKIES_PATH)
     if not cookies_file.exists():
         message = update.effective_message
@@ -181,43 +308,91 @@ async def _handle_create(
     race_id = _current_race_id(context)
     cmd = _build_command(code, discount, usage_limit, race_id, slot_value=slot_value)
     logger.info("Executing: %s", " ".join(shlex.quote(part) for part in cmd))
-    returncode, stdout, stderr = await _run_command(cmd)
+    # Скрипт печатает ACTUAL_CODE сразу после создания промокода, а потом ещё
+    # сохраняет cookies и закрывает браузер. Сообщаем об успехе, не дожидаясь этого.
+    lines_before: List[bytes] = []
+    lines_after: List[bytes] = []
+    announced = False
+
+    async def _on_stdout_line(line: bytes) -> None:
+        nonlocal announced
+        if announced:
+            lines_after.append(line)
+            return
+        if line.startswith(ACTUAL_CODE_MARKER):
+            actual_code = line[len(ACTUAL_CODE_MARKER):].decode("utf-8", "ignore").strip()
+            if actual_code:
+                announced = True
+                output = b"".join(lines_before).decode("utf-8", "ignore").strip()
+                try:
+                    await _reply_promo_created(message, output, actual_code)
+                except Exception as exc:  # pylint: disable=broad-except
+                    logger.warning("Не удалось отправить сообщение о созданном промокоде: %s", exc)
+                return
+        lines_before.append(line)
+
+    returncode, stdout_bytes, stderr_bytes = await _run_command(cmd, _on_stdout_line)
+
+    if announced:
+        # Промокод уже создан и об этом сообщено; ошибка могла случиться только
+        # при сохранении cookies или закрытии браузера.
+        tail = b"".join(lines_after)
+        if returncode == 0:
+            if tail.strip():
+                logger.info("Вывод после создания промокода %s: %s", code, tail.decode("utf-8", "ignore").strip())
+            return
+        combined = await asyncio.to_thread(_format_command_error, tail, stderr_bytes)
+        logger.warning("Промокод %s создан, но скрипт завершился с кодом %s: %s", code, returncode, combined)
+        if message:
+            await message.reply_text(
+                f"⚠️ Промокод {code} создан, но не удалось сохранить cookies или закрыть браузер "
+                f"(exit {returncode}):\n{combined}"
+            )
+        return
 
     if returncode == 0:
-        lines = [line.strip() for line in stdout.splitlines() if line.strip()]
-        actual_code = None
-        filtered: List[str] = []
-        for line in lines:
-            if line.startswith("ACTUAL_CODE:"):
-                actual_code = line.split(":", 1)[1].strip()
-            else:
-                filtered.append(line)
+        actual_code, output = await asyncio.to_thread(_parse_promo_stdout, stdout_bytes)
         if actual_code:
-            if filtered:
-                if message:
-                    await message.reply_text("\n".join(filtered))
-            from html import escape as _html_escape
-            if message:
-                await message.reply_text(
-                    f"🎉 Промокод создан: <code>{_html_escape(actual_code)}</code>",
-                    parse_mode=ParseMode.HTML,
-                )
+            await _reply_promo_created(message, output, actual_code)
         else:
-            message = "\n".join(filtered) if filtered else "✅ Готово."
+            message = output or "✅ Готово."
             if update.effective_message:
                 await update.effective_message.reply_text(message)
     else:
-        combined = (stderr.strip() or stdout.strip() or "Неизвестная ошибка")
+        combined = await asyncio.to_thread(_format_command_error, stdout_bytes, stderr_bytes)
         if message:
             await message.reply_text(
                 f"❌ Ошибка при создании промокода {code} (exit {returncode}):\n{combined}"
             )
 
 
-def _parse_args(args: List[str], expected: int, optional: int = 0) -> Optional[List[str]]:
-    if len(args) < expected or len(args) > expected + optional:
-        return None
-    return args
+def _parse_promo_args(
+    args: List[str],
+    *,
+    want_discount: bool,
+) -> Union[Tuple[str, int, int, Optional[str]], str]:
+    # Возвращает (код, скидка, лимит, слоты) или текст ошибки для ответа.
+    if want_discount:
+        if not 2 <= len(args) <= 4:
+            return "ℹ️ Использование: /promo <код> <скидка> [лимит] [слоты]"
+        code, discount_text, *rest = args
+        try:
+            discount = int(discount_text)
+        except ValueError:
+            return "⚠️ Скидка должна быть числом."
+    else:
+        if not 1 <= len(args) <= 2:
+            return "ℹ️ Использование: /promo100 <код> [лимит]"
+        code, *rest = args
+        discount = 100
+    usage_limit = DEFAULT_USAGE_LIMIT
+    if rest:
+        try:
+            usage_limit = max(1, int(rest[0]))
+        except ValueError:
+            return "⚠️ Лимит должен быть числом."
+    slot_value = rest[1] if len(rest) > 1 else None
+    return code, discount, usage_limit, slot_value
 
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -235,42 +410,20 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
 
 
 async def promo100(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    args = _parse_args(context.args, expected=1, optional=1)
-    if args is None:
-        await update.message.reply_text("ℹ️ Использование: /promo100 <код> [лимит]")
+    result = _parse_promo_args(context.args or [], want_discount=False)
+    if isinstance(result, str):
+        await update.message.reply_text(result)
         return
-    code = args[0]
-    usage_limit = DEFAULT_USAGE_LIMIT
-    if len(args) == 2:
-        try:
-            usage_limit = max(1, int(args[1]))
-        except ValueError:
-            await update.message.reply_text("⚠️ Лимит должен быть числом.")
-            return
-    await _handle_create(update, context, code, discount=100, usage_limit=usage_limit)
+    code, discount, usage_limit, _ = result
+    await _handle_create(update, context, code, discount=discount, usage_limit=usage_limit)
 
 
 async def promo(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    args = _parse_args(context.args, expected=2, optional=2)
-    if args is None:
-        await update.message.reply_text("ℹ️ Использование: /promo <код> <скидка> [лимит] [слоты]")
+    result = _parse_promo_args(context.args or [], want_discount=True)
+    if isinstance(result, str):
+        await update.message.reply_text(result)
         return
-    code = args[0]
-    try:
-        discount = int(args[1])
-    except ValueError:
-        await update.message.reply_text("⚠️ Скидка должна быть числом.")
-        return
-    usage_limit = DEFAULT_USAGE_LIMIT
-    slot_value = None
-    if len(args) >= 3:
-        try:
-            usage_limit = max(1, int(args[2]))
-        except ValueError:
-            await update.message.reply_text("⚠️ Лимит должен быть числом.")
-            return
-    if len(args) == 4:
-        slot_value = args[3]
+    code, discount, usage_limit, slot_value = result
     await _handle_create(
         update,
         context,
@@ -290,20 +443,52 @@ def _load_cookies() -> MozillaCookieJar:
     return jar
 
 
-def _build_metrics_session() -> requests.Session:
-    session = requests.Session()
-    session.headers.update(
-        {
-            "User-Agent": "Mozilla/5.0 (X11; Linux x86_64) MyRaceHelperBot/1.0",
-            "Accept-Language": "ru-RU,ru;q=0.9,en-US;q=0.8,en;q=0.7",
-        }
-    )
-    session.cookies = _load_cookies()
-    return session
+# Одна сессия на весь бот: соединения с myrace.info остаются тёплыми между
+# командами. Обработчики зовут её из рабочих потоков, поэтому создание и
+# перезагрузка cookies идут под threading.Lock. Jar перечитывается только
+# после изменения cookie-файла (например, через /setcookies).
+_SHARED_SESSION: Optional[requests.Session] = None
+_SHARED_COOKIES_MTIME: Optional[int] = None
+_SHARED_SESSION_LOCK = threading.Lock()
+
+
+def _get_shared_session() -> requests.Session:
+    global _SHARED_SESSION, _SHARED_COOKIES_MTIME  # pylint: disable=global-statement
+    jar_path = Path(COOKIES_PATH)
+    with _SHARED_SESSION_LOCK:
+        try:
+            mtime = jar_path.stat().st_mtime_ns
+        except FileNotFoundError:
+            _SHARED_COOKIES_MTIME = None
+            raise FileNotFoundError(f"Файл cookies {jar_path} не найден") from None
+        if _SHARED_SESSION is None:
+            _SHARED_SESSION = build_session(
+                pool_maxsize=SHARED_SESSION_POOL_SIZE,
+                max_retries=Retry(total=2, backoff_factor=0.3),
+            )
+        if mtime != _SHARED_COOKIES_MTIME:
+            _SHARED_SESSION.cookies = _load_cookies()
+            _SHARED_COOKIES_MTIME = mtime
+        return _SHARED_SESSION
+
+
+# Блокирующие запросы к myrace.info идут в отдельный пул по числу соединений
+# сессии, а не в общий пул asyncio.to_thread: медленный сайт не должен
+# занимать потоки, нужные для разбора вывода, целей и /checkpromos.
+T = TypeVar("T")
+_HTTP_EXECUTOR = ThreadPoolExecutor(
+    max_workers=SHARED_SESSION_POOL_SIZE,
+    thread_name_prefix="myrace-http",
+)
+
+
+async def _run_http(func: Callable[..., T], *args) -> T:
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_HTTP_EXECUTOR, functools.partial(func, *args))
 
 
 def _fetch_income_metrics_sync(race_id: str) -> RaceMetrics:
-    session = _build_metrics_session()
+    session = _get_shared_session()
     return fetch_race_metrics(session, race_id)
 
 
@@ -336,9 +521,18 @@ def _parse_goal_amount(value: str) -> Decimal:
     return amount
 
 
+# Валидаторы последнего разобранного списка гонок с сайта: (ETag,
+# Last-Modified, ключ, гонки). Ключ — mtime cookie-файла и набор ручных гонок,
+# при их изменении список запрашивается без условных заголовков. Вызывается
+# только из _fetch_races_cached, то есть под _RACES_FETCH_LOCK.
+_RACE_LIST_VALIDATORS: Optional[
+    Tuple[Optional[str], Optional[str], Tuple[Optional[int], frozenset], List[Tuple[str, str]]]
+] = None
+
+
 def _fetch_races() -> List[Tuple[str, str]]:
-    session = requests.Session()
-    session.cookies = _load_cookies()
+    global _RACE_LIST_VALIDATORS  # pylint: disable=global-statement
+    session = _get_shared_session()
     races: List[Tuple[str, str]] = []
     seen = set()
 
@@ -348,10 +542,20 @@ def _fetch_races() -> List[Tuple[str, str]]:
             seen.add(race_id)
 
     target = "https://myrace.info/race/list"
+    validators_key = (_cookies_mtime(), frozenset(seen))
+    validators = _RACE_LIST_VALIDATORS
+    if validators is not None and validators[2] != validators_key:
+        validators = _RACE_LIST_VALIDATORS = None
     parsed_any = False
     for attempt in range(2):
+        headers: Dict[str, str] = {}
+        if validators is not None:
+            if validators[0]:
+                headers["If-None-Match"] = validators[0]
+            if validators[1]:
+                headers["If-Modified-Since"] = validators[1]
         try:
-            response = session.get(target, timeout=30)
+            response = session.get(target, headers=headers, timeout=30)
             response.raise_for_status()
         except Exception as exc:  # pylint: disable=broad-except
             logger.warning("Не удалось загрузить список гонок (попытка %s): %s", attempt + 1, exc)
@@ -359,36 +563,62 @@ def _fetch_races() -> List[Tuple[str, str]]:
                 continue
             return races
 
+        if response.status_code == 304 and validators is not None:
+            races.extend(validators[3])
+            return races
+
         if response.url.rstrip('/') != target.rstrip('/') and attempt == 0:
             logger.info("Получен ответ с URL %s, пробуем повторно запросить список гонок.", response.url)
             continue
 
-        soup = BeautifulSoup(response.text, "html.parser")
-        new_items = 0
+        soup = BeautifulSoup(response.content, "lxml", parse_only=RACE_LINKS_STRAINER)
+        # Сначала собираем ссылки по гонкам, затем недостающие названия
+        # загружаем параллельно, а не по одному запросу на ссылку.
+        anchor_titles: Dict[str, List[str]] = {}
         for tag in soup.find_all("a", href=True):
             href = tag["href"]
-            match = re.search(r"/races/(\d+)", href)
-            if not match:
-                match = re.search(r"/entities/races/(\d+)", href)
+            match = RACE_HREF_RE.search(href)
             if not match:
                 continue
             race_id = match.group(1)
             if race_id in seen:
                 continue
-            title = tag.get_text(strip=True)
-            if not title or _looks_like_placeholder(title):
-                fetched = _fetch_race_title(session, race_id)
-                if fetched:
-                    title = fetched
+            anchor_titles.setdefault(race_id, []).append(tag.get_text(strip=True))
+
+        to_fetch = [
+            race_id
+            for race_id, titles in anchor_titles.items()
+            if not titles[0] or _looks_like_placeholder(titles[0])
+        ]
+        fetched_titles: Dict[str, Optional[str]] = {}
+        if to_fetch:
+            with ThreadPoolExecutor(max_workers=min(TITLE_FETCH_WORKERS, len(to_fetch))) as executor:
+                fetched_titles = dict(
+                    zip(to_fetch, executor.map(lambda rid: _fetch_race_title(session, rid), to_fetch))
+                )
+
+        site_races: List[Tuple[str, str]] = []
+        for race_id, titles in anchor_titles.items():
+            for title in titles:
+                if not title or _looks_like_placeholder(title):
+                    title = fetched_titles.get(race_id) or title
+                if title:
+                    break
             if not title:
                 continue
-            races.append((race_id, title))
+            site_races.append((race_id, title))
             seen.add(race_id)
-            new_items += 1
-        if new_items == 0 and attempt == 0:
+        races.extend(site_races)
+        if not site_races and attempt == 0:
             logger.info("Список гонок пуст, пробуем повторно запросить страницу.")
             continue
-        parsed_any = parsed_any or new_items > 0
+        parsed_any = parsed_any or bool(site_races)
+        etag = response.headers.get("ETag")
+        last_modified = response.headers.get("Last-Modified")
+        if site_races and (etag or last_modified):
+            _RACE_LIST_VALIDATORS = (etag, last_modified, validators_key, site_races)
+        else:
+            _RACE_LIST_VALIDATORS = None
         break
 
     if not parsed_any:
@@ -396,6 +626,115 @@ def _fetch_races() -> List[Tuple[str, str]]:
     return races
 
 
+# Список гонок нужен /races, /income и кнопкам выбора гонки подряд; кэшируем
+# его на RACES_CACHE_TTL секунд. Ключ — mtime cookie-файла: после /setcookies
+# список перезапрашивается сразу, после /addrace кэш сбрасывается явно.
+# _RACES_CACHE_LOCK держим только на чтение/запись кэша, не на время сетевого
+# запроса: его берёт и _invalidate_races_cache, вызываемая из event loop.
+# Сами загрузки идут по одной под _RACES_FETCH_LOCK, а счётчик поколений не
+# даёт результату, начатому до сброса, попасть в кэш.
+_RACES_CACHE: Optional[Tuple[float, Optional[int], List[Tuple[str, str]]]] = None
+_RACES_CACHE_GENERATION = 0
+_RACES_CACHE_LOCK = threading.Lock()
+_RACES_FETCH_LOCK = threading.Lock()
+
+
+def _cookies_mtime() -> Optional[int]:
+    try:
+        return Path(COOKIES_PATH).stat().st_mtime_ns
+    except OSError:
+        return None
+
+
+def _invalidate_races_cache() -> None:
+    global _RACES_CACHE, _RACES_CACHE_GENERATION  # pylint: disable=global-statement
+    with _RACES_CACHE_LOCK:
+        _RACES_CACHE = None
+        _RACES_CACHE_GENERATION += 1
+
+
+def _cached_races(mtime: Optional[int]) -> Optional[List[Tuple[str, str]]]:
+    with _RACES_CACHE_LOCK:
+        cached = _RACES_CACHE
+    if cached is not None and cached[1] == mtime and time.monotonic() - cached[0] < RACES_CACHE_TTL:
+        return list(cached[2])
+    return None
+
+
+def _fetch_races_cached() -> List[Tuple[str, str]]:
+    global _RACES_CACHE  # pylint: disable=global-statement
+    mtime = _cookies_mtime()
+    races_list = _cached_races(mtime)
+    if races_list is not None:
+        return races_list
+    with _RACES_FETCH_LOCK:
+        # Пока ждали блокировку, список мог загрузить другой поток.
+        races_list = _cached_races(mtime)
+        if races_list is not None:
+            return races_list
+        with _RACES_CACHE_LOCK:
+            generation = _RACES_CACHE_GENERATION
+        races_list = _fetch_races()
+        with _RACES_CACHE_LOCK:
+            if generation == _RACES_CACHE_GENERATION:
+                _RACES_CACHE = (time.monotonic(), mtime, races_list)
+        return list(races_list)
+
+
+# Одновременные команды ждут один и тот же запрос списка гонок вместо того,
+# чтобы занимать по потоку HTTP-пула на каждую.
+_RACES_INFLIGHT: Optional["asyncio.Task[List[Tuple[str, str]]]"] = None
+
+
+def _clear_races_inflight(task: "asyncio.Task[List[Tuple[str, str]]]") -> None:
+    global _RACES_INFLIGHT  # pylint: disable=global-statement
+    if _RACES_INFLIGHT is task:
+        _RACES_INFLIGHT = None
+
+
+async def _get_races_list() -> List[Tuple[str, str]]:
+    global _RACES_INFLIGHT  # pylint: disable=global-statement
+    task = _RACES_INFLIGHT
+    if task is None:
+        task = asyncio.create_task(_run_http(_fetch_races_cached))
+        _RACES_INFLIGHT = task
+        task.add_done_callback(_clear_races_inflight)
+    # shield: отмена одного обработчика не должна обрывать запрос для остальных.
+    return list(await asyncio.shield(task))
+
+
+def _remember_races_list(
+    context: ContextTypes.DEFAULT_TYPE,
+    races_list: List[Tuple[str, str]],
+) -> Dict[str, str]:
+    # Словарь рядом со списком: кнопка гонки ищет название без перебора.
+    races_map = dict(races_list)
+    context.chat_data["races_last_list"] = races_list
+    context.chat_data["races_last_map"] = races_map
+    return races_map
+
+
+def _race_button_rows(
+    races_list: List[Tuple[str, str]],
+    current: str,
+    action: str,
+) -> List[List[InlineKeyboardButton]]:
+    flat = [
+        InlineKeyboardButton(
+            f"{'⭐️' if race_id == current else '🏁'} {race_id} · "
+            f"{title if len(title) <= 20 else title[:17] + '…'}",
+            callback_data=f"{action}:{race_id}",
+        )
+        for race_id, title in races_list[:MAX_RACE_BUTTONS]
+    ]
+    # По две кнопки в ряд; itertools.batched появился только в Python 3.12.
+    return [flat[index:index + 2] for index in range(0, len(flat), 2)]
+
+
+def _races_view_hash(races_list: List[Tuple[str, str]], current: str) -> int:
+    return hash((tuple(races_list), current))
+
+
 def _format_races_response(
     races_list: List[Tuple[str, str]],
     current: str,
@@ -405,20 +744,7 @@ def _format_races_response(
         marker = " ⭐️" if race_id == current else ""
         lines.append(f"• {race_id}: {title}{marker}")
 
-    buttons: List[List[InlineKeyboardButton]] = []
-    row: List[InlineKeyboardButton] = []
-    for race_id, title in races_list[:MAX_RACE_BUTTONS]:
-        prefix = "⭐️" if race_id == current else "🏁"
-        display = title if len(title) <= 20 else f"{title[:17]}…"
-        label = f"{prefix} {race_id} · {display}"
-        button = InlineKeyboardButton(label, callback_data=f"race:{race_id}")
-        row.append(button)
-        if len(row) == 2:
-            buttons.append(row)
-            row = []
-    if row:
-        buttons.append(row)
-
+    buttons = _race_button_rows(races_list, current, "race")
     markup = InlineKeyboardMarkup(buttons) if buttons else None
     return "\n".join(lines), markup
 
@@ -431,43 +757,30 @@ def _format_income_keyboard(
         "💰 Выберите гонку, чтобы получить текущий доход и количество участников.",
         "Можно нажимать кнопки несколько раз для разных гонок.",
     ]
-    buttons: List[List[InlineKeyboardButton]] = []
-    row: List[InlineKeyboardButton] = []
-    for race_id, title in races_list[:MAX_RACE_BUTTONS]:
-        prefix = "⭐️" if race_id == current else "🏁"
-        display = title if len(title) <= 20 else f"{title[:17]}…"
-        label = f"{prefix} {race_id} · {display}"
-        row.append(InlineKeyboardButton(label, callback_data=f"income:{race_id}"))
-        if len(row) == 2:
-            buttons.append(row)
-            row = []
-    if row:
-        buttons.append(row)
+    buttons = _race_button_rows(races_list, current, "income")
     markup = InlineKeyboardMarkup(buttons) if buttons else None
     return "\n".join(lines), markup
 
 
 def _format_income_response(metrics: RaceMetrics, goal: Optional[Decimal] = None) -> str:
-    title = escape(metrics.title)
-    lines = [
-        f"🏁 <b>{title}</b> (ID {metrics.race_id})",
-        f"👥 Участников: <b>{metrics.participants}</b>",
-        f"💰 Доход: <b>{format_money(metrics.revenue)} ₽</b>",
-    ]
+    text = (
+        f"🏁 <b>{escape(metrics.title)}</b> (ID {metrics.race_id})\n"
+        f"👥 Участников: <b>{metrics.participants}</b>\n"
+        f"💰 Доход: <b>{format_money(metrics.revenue)} ₽</b>"
+    )
     if goal is not None:
         target_text = format_money(goal)
         remaining = goal - metrics.revenue
         if remaining > 0:
-            remaining_text = format_money(remaining)
-            lines.append(f"🎯 Цель: {target_text} ₽ (осталось {remaining_text} ₽)")
+            text += f"\n🎯 Цель: {target_text} ₽ (осталось {format_money(remaining)} ₽)"
         else:
-            lines.append(f"🎯 Цель: {target_text} ₽ достигнута или превышена!")
-    return "\n".join(lines)
+            text += f"\n🎯 Цель: {target_text} ₽ достигнута или превышена!"
+    return text
 
 
 async def races(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     try:
-        races_list = await asyncio.to_thread(_fetch_races)
+        races_list = await _get_races_list()
     except Exception as exc:  # pylint: disable=broad-except
         await update.message.reply_text(f"❌ Не удалось получить список гонок: {exc}")
         return
@@ -477,23 +790,17 @@ async def races(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         return
 
     current = _current_race_id(context)
-    context.chat_data["races_last_list"] = races_list
+    _remember_races_list(context, races_list)
     text, markup = _format_races_response(races_list, current)
-    await update.message.reply_text(text, reply_markup=markup)
+    sent = await update.message.reply_text(text, reply_markup=markup)
+    context.chat_data["races_last_sent"] = (sent.message_id, _races_view_hash(races_list, current))
 
 
+@admin_only("read income")
 async def income(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    user = update.effective_user
-    user_id = user.id if user else None
     message = update.effective_message
-    if ADMIN_IDS and user_id not in ADMIN_IDS:
-        if message:
-            await message.reply_text("⛔️ пошел на хуй пидарас")
-        logger.warning("User %s attempted to read income without permissions", user_id)
-        return
-
     try:
-        races_list = await asyncio.to_thread(_fetch_races)
+        races_list = await _get_races_list()
     except Exception as exc:  # pylint: disable=broad-except
         logger.exception("Не удалось загрузить гонки для income: %s", exc)
         if message:
@@ -511,16 +818,9 @@ async def income(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         await message.reply_text(text, reply_markup=markup)
 
 
+@admin_only("modify goals")
 async def goal(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    user = update.effective_user
-    user_id = user.id if user else None
     message = update.effective_message
-    if ADMIN_IDS and user_id not in ADMIN_IDS:
-        if message:
-            await message.reply_text("⛔️ пошел на хуй пидарас")
-        logger.warning("User %s attempted to modify goals without permissions", user_id)
-        return
-
     args = context.args or []
     current_race = _current_race_id(context)
 
@@ -596,7 +896,7 @@ async def handle_income_callback(update: Update, context: ContextTypes.DEFAULT_T
     race_id = query.data.split(":", 1)[1]
     parse_mode = None
     try:
-        metrics = await asyncio.to_thread(_fetch_income_metrics_sync, race_id)
+        metrics = await _run_http(_fetch_income_metrics_sync, race_id)
         goals = await asyncio.to_thread(load_income_goals, INCOME_GOALS_PATH)
         goal_value = goals.get(race_id)
     except FileNotFoundError:
@@ -625,34 +925,32 @@ async def handle_race_callback(update: Update, context: ContextTypes.DEFAULT_TYP
     context.chat_data["race_id"] = race_id
 
     races_list = context.chat_data.get("races_last_list")
-    title: Optional[str] = None
-    if isinstance(races_list, list):
-        for rid, name in races_list:
-            if rid == race_id:
-                title = name
-                break
-    else:
+    if not isinstance(races_list, list):
         races_list = None
-
-    if races_list is None:
         try:
-            races_list = await asyncio.to_thread(_fetch_races)
-            context.chat_data["races_last_list"] = races_list
-            for rid, name in races_list:
-                if rid == race_id:
-                    title = name
-                    break
+            races_list = await _get_races_list()
+            _remember_races_list(context, races_list)
         except Exception as exc:  # pylint: disable=broad-except
             logger.warning("Не удалось обновить список гонок: %s", exc)
             races_list = None
 
+    races_map = context.chat_data.get("races_last_map")
+    if races_list is not None and not isinstance(races_map, dict):
+        races_map = _remember_races_list(context, races_list)
+    title: Optional[str] = races_map.get(race_id) if races_list is not None else None
+
     current = _current_race_id(context)
     if query.message and races_list:
-        text, markup = _format_races_response(races_list, current)
-        try:
-            await query.edit_message_text(text, reply_markup=markup)
-        except Exception as exc:  # pylint: disable=broad-except
-            logger.debug("Не удалось обновить сообщение списка гонок: %s", exc)
+        # Сообщение уже показывает этот список с этой выбранной гонкой —
+        # повторная отправка клавиатуры в Telegram ничего не изменит.
+        sent_state = (query.message.message_id, _races_view_hash(races_list, current))
+        if context.chat_data.get("races_last_sent") != sent_state:
+            text, markup = _format_races_response(races_list, current)
+            try:
+                await query.edit_message_text(text, reply_markup=markup)
+                context.chat_data["races_last_sent"] = sent_state
+            except Exception as exc:  # pylint: disable=broad-except
+                logger.debug("Не удалось обновить сообщение списка гонок: %s", exc)
 
     toast = f"🏁 Выбрана гонка {race_id}"
     if title:
@@ -673,32 +971,30 @@ async def setrace(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     await update.message.reply_text(f"✅ Текущая гонка установлена: {race_id}.")
 
 
+def _fetch_added_race_title(url: str, race_id: str) -> str:
+    session = _get_shared_session()
+    response = session.get(url, timeout=30)
+    response.raise_for_status()
+    soup = BeautifulSoup(response.content, "lxml", parse_only=RACE_TITLE_STRAINER)
+    title_tag = soup.find("h1") or soup.find("title")
+    return title_tag.get_text(strip=True) if title_tag else f"Гонка {race_id}"
+
+
+@admin_only("add race")
 async def add_race(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    user = update.effective_user
-    user_id = user.id if user else None
-    if ADMIN_IDS and user_id not in ADMIN_IDS:
-        await update.message.reply_text("⛔️ пошел на хуй пидарас")
-        logger.warning("User %s attempted to add race without permissions", user_id)
-        return
     if not context.args:
         await update.message.reply_text("ℹ️ Использование: /addrace https://myrace.info/events/<id>")
         return
     url = context.args[0].strip()
 
-    match = re.search(r"(\d+)", url)
+    match = RACE_ID_RE.search(url)
     if not match:
         await update.message.reply_text("⚠️ Не удалось определить ID гонки из ссылки.")
         return
     race_id = match.group(1)
 
     try:
-        session = requests.Session()
-        session.cookies = _load_cookies()
-        response = session.get(url, timeout=30)
-        response.raise_for_status()
-        soup = BeautifulSoup(response.text, "html.parser")
-        title_tag = soup.find("h1") or soup.find("title")
-        title = title_tag.get_text(strip=True) if title_tag else f"Гонка {race_id}"
+        title = await _run_http(_fetch_added_race_title, url, race_id)
     except Exception as exc:  # pylint: disable=broad-except
         await update.message.reply_text(f"❌ Не удалось загрузить страницу гонки: {exc}")
         return
@@ -712,14 +1008,34 @@ async def add_race(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         await update.message.reply_text(f"ℹ️ Гонка {race_id} уже есть в списке.")
 
 
-async def checkpromos(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    user = update.effective_user
-    user_id = user.id if user else None
-    if ADMIN_IDS and user_id not in ADMIN_IDS:
-        await update.message.reply_text("⛔️ пошел на хуй пидарас")
-        logger.warning("User %s attempted to inspect promos without permissions", user_id)
-        return
+def _pack_message_chunks(blocks: List[str], limit: int = TELEGRAM_CHUNK_LIMIT) -> List[str]:
+    # Склеиваем блоки через пустую строку, пока сообщение не превысит limit;
+    # слишком длинный блок режем по строкам.
+    pieces: List[Tuple[str, str]] = []
+    for block in blocks:
+        if len(block) <= limit:
+            pieces.append(("\n\n", block))
+        else:
+            lines = block.split("\n")
+            pieces.append(("\n\n", lines[0]))
+            pieces.extend(("\n", line) for line in lines[1:])
+
+    chunks: List[str] = []
+    current = ""
+    for separator, piece in pieces:
+        if current and len(current) + len(separator) + len(piece) <= limit:
+            current += separator + piece
+            continue
+        if current:
+            chunks.append(current)
+        current = piece
+    if current:
+        chunks.append(current)
+    return chunks
+
 
+@admin_only("inspect promos")
+async def checkpromos(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     cookies_file = Path(COOKIES_PATH)
     if not cookies_file.exists():
         await update.message.reply_text(
@@ -738,8 +1054,11 @@ async def checkpromos(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
         except Exception as exc:  # pragma: no cover
             logger.debug("Не удалось обновить сообщение прогресса: %s", exc)
 
+    # Рабочий поток кладёт состояние в очередь из одного элемента (старое
+    # вытесняется новым), а одна фоновая задача правит сообщение не чаще раза в
+    # PROGRESS_UPDATE_INTERVAL: одновременно висит не больше одного edit_text.
     loop = asyncio.get_running_loop()
-    progress_state = {"last": 0.0}
+    progress_queue: "asyncio.Queue[Optional[Tuple[int, int, str]]]" = asyncio.Queue(maxsize=1)
 
     async def _edit_progress(step: int, pending: int, current_url: str) -> None:
         total = step + pending
@@ -749,18 +1068,35 @@ async def checkpromos(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
         lines.append("Это может занять пару минут…")
         await _set_progress("\n".join(lines))
 
+    def _offer_progress(snapshot: Optional[Tuple[int, int, str]]) -> None:
+        if progress_queue.full():
+            progress_queue.get_nowait()
+        progress_queue.put_nowait(snapshot)
+
+    async def _progress_updater() -> None:
+        while True:
+            snapshot = await progress_queue.get()
+            if snapshot is None:
+                return
+            await _edit_progress(*snapshot)
+            await asyncio.sleep(PROGRESS_UPDATE_INTERVAL)
+
     def progress_cb(step: int, pending: int, current_url: str) -> None:
-        now = time.monotonic()
-        if now - progress_state["last"] < 0.5:
-            return
-        progress_state["last"] = now
-        loop.call_soon_threadsafe(
-            asyncio.create_task,
-            _edit_progress(step, pending, current_url),
-        )
+        loop.call_soon_threadsafe(_offer_progress, (step, pending, current_url))
+
+    updater_task = asyncio.create_task(_progress_updater())
+
+    async def _stop_updater() -> None:
+        # Дожидаемся, а не отменяем: начатый edit_text должен завершиться до
+        # итогового сообщения, иначе он может его перезаписать.
+        _offer_progress(None)
+        await updater_task
 
     try:
-        promos = await asyncio.to_thread(_gather_promos_with_usage, race_id, progress_cb)
+        try:
+            promos = await asyncio.to_thread(_gather_promos_with_usage, race_id, progress_cb)
+        finally:
+            await _stop_updater()
     except FileNotFoundError:
         await _set_progress("⚠️ Cookie-файл не найден.")
         await update.message.reply_text(
@@ -785,10 +1121,10 @@ async def checkpromos(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
     )
     await _set_progress(f"📦 Найдено {len(promos)} промокодов, фильтрую…")
 
-    active: List[PromoUsageInfo] = [
-        info for info in promos if info.usage_left is None or info.usage_left != 0
-    ]
-    skipped_zero = [info for info in promos if info.usage_left == 0]
+    active: List[PromoUsageInfo] = []
+    skipped_zero: List[PromoUsageInfo] = []
+    for info in promos:
+        (skipped_zero if info.usage_left == 0 else active).append(info)
     if skipped_zero:
         logger.debug(
             "Отфильтровано по нулевому лимиту: %s",
@@ -799,23 +1135,21 @@ async def checkpromos(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
         await update.message.reply_text("✅ Все промокоды израсходованы.")
         return
 
-    def _code_text(info: PromoUsageInfo) -> str:
-        return (info.code or _extract_code_from_url(info.url)).strip()
+    # Текст кода (с разбором URL для безымянных) считаем один раз на промокод:
+    # он нужен и для сортировки, и для вывода.
+    code_texts: Dict[int, str] = {
+        id(info): (info.code or _extract_code_from_url(info.url)).strip() for info in active
+    }
 
     def _sort_key(info: PromoUsageInfo) -> Tuple[int, str]:
         usage = info.usage_left
         usage_key = usage if usage is not None else -1
-        return (usage_key, _code_text(info).lower())
+        return (usage_key, code_texts[id(info)].lower())
 
     sorted_active = sorted(active, key=_sort_key, reverse=True)
-
-    grouped: dict[Optional[int], List[PromoUsageInfo]] = {}
-    for info in sorted_active:
-        grouped.setdefault(info.discount_percent, []).append(info)
-
-    ordered_keys = sorted([k for k in grouped.keys() if k is not None], reverse=True)
-    if None in grouped:
-        ordered_keys.append(None)
+    # Устойчивая сортировка по скидке (по убыванию, неизвестная — в конце)
+    # сохраняет порядок внутри группы, дальше группы режет groupby.
+    sorted_active.sort(key=lambda info: (info.discount_percent is None, -(info.discount_percent or 0)))
 
     def _discount_header(percent: Optional[int]) -> str:
         if percent is None:
@@ -828,31 +1162,28 @@ async def checkpromos(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
             icon = "🔹"
         return f"{icon} Скидка {percent}%"
 
-    summary_totals: List[Tuple[Optional[int], int, int, int]] = []
+    # Заголовок группы считаем один раз и переиспользуем в итоговой сводке.
+    summary_totals: List[Tuple[str, int, int, int]] = []
+    blocks: List[str] = []
 
-    for key in ordered_keys:
-        group_items = grouped.get(key, [])
-        if not group_items:
-            continue
-        lines = [_discount_header(key) + ":"]
+    for key, group_iter in groupby(sorted_active, key=attrgetter("discount_percent")):
+        group_items = list(group_iter)
+        header = _discount_header(key)
+        lines = [header + ":"]
+        known_usage = 0
         unknown_count = 0
+        # Строки и суммы по группе собираем за один проход.
         for info in group_items:
-            code_display = _code_text(info)
-            url_html = escape(info.url)
-            code_html = escape(code_display)
+            link = f"• <a href=\"{escape(info.url)}\">{escape(code_texts[id(info)])}</a>"
             usage = info.usage_left
             if usage is None:
-                lines.append(f"• <a href=\"{url_html}\">{code_html}</a> — лимит не удалось определить")
+                lines.append(link + " — лимит не удалось определить")
                 unknown_count += 1
-                continue
-            lines.append(f"• <a href=\"{url_html}\">{code_html}</a>: осталось {usage}")
-        await update.message.reply_text(
-            "\n".join(lines),
-            parse_mode=ParseMode.HTML,
-            disable_web_page_preview=True,
-        )
-        known_usage = sum(info.usage_left or 0 for info in group_items if info.usage_left is not None)
-        summary_totals.append((key, len(group_items), known_usage, unknown_count))
+            else:
+                lines.append(f"{link}: осталось {usage}")
+                known_usage += usage
+        blocks.append("\n".join(lines))
+        summary_totals.append((header, len(group_items), known_usage, unknown_count))
 
     total_known_usage = sum(entry[2] for entry in summary_totals)
     total_codes = sum(entry[1] for entry in summary_totals)
@@ -862,21 +1193,29 @@ async def checkpromos(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
         "🧮 Итог по промокодам:",
         f"Всего кодов: {total_codes}, мест: {total_known_usage}, без данных: {total_unknown}",
     ]
-    for key, count, usage_sum, unknown_count in summary_totals:
-        label = _discount_header(key)
-        line = f"{label}: кодов {count}, мест {usage_sum}"
+    for header, count, usage_sum, unknown_count in summary_totals:
+        line = f"{header}: кодов {count}, мест {usage_sum}"
         if unknown_count:
             line += f", без данных {unknown_count}"
         summary_lines.append(line)
+    blocks.append("\n".join(summary_lines))
+
+    # Группы и итог уходят минимальным числом сообщений вместо одного на группу.
+    # Сами сообщения шлём по очереди, чтобы итог не обогнал группы, а правку
+    # сообщения прогресса — параллельно с ними.
+    async def _send_chunks() -> None:
+        for chunk in _pack_message_chunks(blocks):
+            await update.message.reply_text(
+                chunk,
+                parse_mode=ParseMode.HTML,
+                disable_web_page_preview=True,
+            )
 
-    await update.message.reply_text(
-        "\n".join(summary_lines),
-        parse_mode=ParseMode.HTML,
-        disable_web_page_preview=True,
+    await asyncio.gather(
+        _send_chunks(),
+        _set_progress(f"✅ Готово! Доступных промокодов: {total_codes}"),
     )
 
-    await _set_progress(f"✅ Готово! Доступных промокодов: {total_codes}")
-
 
 def _wizard_active(context: ContextTypes.DEFAULT_TYPE) -> bool:
     return WIZARD_DATA_KEY in context.user_data
@@ -895,13 +1234,8 @@ def _wizard_clear(context: ContextTypes.DEFAULT_TYPE) -> None:
     context.user_data.pop(WIZARD_STATE_KEY, None)
 
 
+@admin_only("run promo wizard")
 async def promo_wizard_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    user = update.effective_user
-    user_id = user.id if user else None
-    if ADMIN_IDS and user_id not in ADMIN_IDS:
-        await update.message.reply_text("⛔️ пошел на хуй пидарас")
-        logger.warning("User %s attempted to run promo wizard without permissions", user_id)
-        return
     if not Path(COOKIES_PATH).exists():
         await update.message.reply_text(
             "⚠️ Cookie-файл не найден. Сначала выполните /setcookies с актуальными данными."
@@ -1168,28 +1502,49 @@ class PromoUsageInfo:
     discount_percent: Optional[int] = None
 
 
+# Ручные гонки читаются при каждом /races и /addrace; разобранный список
+# кэшируем по mtime файла, так что на тёплом пути остаётся один stat().
+_MANUAL_RACES_CACHE: Optional[Tuple[int, List[Tuple[str, str]]]] = None
+_MANUAL_RACES_LOCK = threading.Lock()
+
+
 def _load_manual_races() -> List[Tuple[str, str]]:
-    if not RACES_STORE_PATH.exists():
-        return []
+    global _MANUAL_RACES_CACHE  # pylint: disable=global-statement
     try:
-        data = json.loads(RACES_STORE_PATH.read_text(encoding="utf-8"))
-    except json.JSONDecodeError:
-        logger.warning("Не удалось разобрать %s, игнорируем", RACES_STORE_PATH)
+        mtime = RACES_STORE_PATH.stat().st_mtime_ns
+    except OSError:
         return []
-    races: List[Tuple[str, str]] = []
-    for item in data:
-        if not isinstance(item, dict):
-            continue
-        race_id = str(item.get("id", "")).strip()
-        title = str(item.get("title", "")).strip()
-        if race_id and title:
-            races.append((race_id, title))
-    return races
+    with _MANUAL_RACES_LOCK:
+        cached = _MANUAL_RACES_CACHE
+        if cached is not None and cached[0] == mtime:
+            return list(cached[1])
+        try:
+            if orjson is not None:
+                data = orjson.loads(RACES_STORE_PATH.read_bytes())
+            else:
+                data = json.loads(RACES_STORE_PATH.read_text(encoding="utf-8"))
+        except json.JSONDecodeError:
+            logger.warning("Не удалось разобрать %s, игнорируем", RACES_STORE_PATH)
+            return []
+        races: List[Tuple[str, str]] = []
+        for item in data:
+            if not isinstance(item, dict):
+                continue
+            race_id = str(item.get("id", "")).strip()
+            title = str(item.get("title", "")).strip()
+            if race_id and title:
+                races.append((race_id, title))
+        _MANUAL_RACES_CACHE = (mtime, races)
+        return list(races)
 
 
 def _save_manual_races(races: List[Tuple[str, str]]) -> None:
+    global _MANUAL_RACES_CACHE  # pylint: disable=global-statement
     payload = [{"id": race_id, "title": title} for race_id, title in races]
-    RACES_STORE_PATH.write_text(json.dumps(payload, ensure_ascii=False, indent=2), encoding="utf-8")
+    with _MANUAL_RACES_LOCK:
+        RACES_STORE_PATH.write_text(json.dumps(payload, ensure_ascii=False, indent=2), encoding="utf-8")
+        _MANUAL_RACES_CACHE = None
+    _invalidate_races_cache()
 
 
 
@@ -1200,7 +1555,17 @@ def _looks_like_placeholder(title: str) -> bool:
     return all(ch.isdigit() or ch in "-./ " for ch in stripped)
 
 
+# Названия гонок не меняются в течение сессии: удачно загруженные держим
+# RACE_TITLE_TTL секунд, чтобы не ходить за ними при каждом обновлении списка.
+_RACE_TITLE_CACHE: Dict[str, Tuple[float, str]] = {}
+_RACE_TITLE_CACHE_LOCK = threading.Lock()
+
+
 def _fetch_race_title(session: requests.Session, race_id: str) -> Optional[str]:
+    with _RACE_TITLE_CACHE_LOCK:
+        cached = _RACE_TITLE_CACHE.get(race_id)
+    if cached is not None and time.monotonic() - cached[0] < RACE_TITLE_TTL:
+        return cached[1]
     url = f"https://myrace.info/events/{race_id}"
     try:
         response = session.get(url, timeout=30)
@@ -1209,10 +1574,14 @@ def _fetch_race_title(session: requests.Session, race_id: str) -> Optional[str]:
         logger.warning("Не удалось загрузить страницу гонки %s: %s", race_id, exc)
         return None
 
-    soup = BeautifulSoup(response.text, "html.parser")
+    soup = BeautifulSoup(response.content, "lxml", parse_only=RACE_TITLE_STRAINER)
     title_tag = soup.find("h1") or soup.find("title")
     if title_tag:
-        return title_tag.get_text(strip=True)
+        title = title_tag.get_text(strip=True)
+        if title:
+            with _RACE_TITLE_CACHE_LOCK:
+                _RACE_TITLE_CACHE[race_id] = (time.monotonic(), title)
+        return title
     return None
 
 
@@ -1222,13 +1591,14 @@ USAGE_LABELS = [
     "Maximum number of use",
     "Maximum number of uses",
 ]
+USAGE_LABEL_RE = re.compile("|".join(re.escape(label) for label in USAGE_LABELS), re.IGNORECASE)
 
 
 def _extract_first_int(text: str) -> Optional[int]:
     if text is None:
         return None
     cleaned = text.replace("\xa0", " ")
-    match = re.search(r"-?\d+", cleaned)
+    match = INT_RE.search(cleaned)
     if not match:
         return None
     try:
@@ -1238,13 +1608,16 @@ def _extract_first_int(text: str) -> Optional[int]:
 
 
 def _extract_code_from_html(html: str) -> Optional[str]:
-    soup = BeautifulSoup(html, "html.parser")
+    # Сначала разбираем только <input>: обычно код лежит в поле формы, и
+    # полное дерево со всеми текстовыми узлами не понадобится.
+    inputs = BeautifulSoup(html, "lxml", parse_only=INPUT_STRAINER)
     for attrs in ({"id": "code"}, {"name": "code"}):
-        field = soup.find("input", attrs=attrs)
+        field = inputs.find("input", attrs=attrs)
         if field:
             value = field.get("value", "").strip()
             if value:
                 return value
+    soup = BeautifulSoup(html, "lxml")
     anchor = soup.select_one("table.items td.text-strong a[href*='/promo/view/']")
     if anchor:
         text_value = anchor.get_text(strip=True)
@@ -1254,7 +1627,7 @@ def _extract_code_from_html(html: str) -> Optional[str]:
         stripped = candidate.strip()
         if not stripped:
             continue
-        if not re.fullmatch(r"[A-Z0-9-]{4,16}", stripped):
+        if not PROMO_CODE_RE.fullmatch(stripped):
             continue
         if stripped.upper() == "MYRACE":
             continue
@@ -1263,11 +1636,9 @@ def _extract_code_from_html(html: str) -> Optional[str]:
 
 
 def _extract_usage_value(html: str) -> Optional[int]:
-    soup = BeautifulSoup(html, "html.parser")
-    for label in USAGE_LABELS:
-        node = soup.find(string=re.compile(re.escape(label), re.IGNORECASE))
-        if not node:
-            continue
+    soup = BeautifulSoup(html, "lxml")
+    # Все подписи ищем за один обход дерева, а не отдельным find на каждую.
+    for node in soup.find_all(string=USAGE_LABEL_RE):
         element = node.parent
         if not element:
             continue
@@ -1302,7 +1673,7 @@ def _extract_usage_value(html: str) -> Optional[int]:
             value = _extract_first_int(text)
             if value is not None:
                 return value
-        candidate = element.find_next(string=re.compile(r"\d"))
+        candidate = element.find_next(string=DIGIT_RE)
         if candidate:
             value = _extract_first_int(candidate.strip())
             if value is not None:
@@ -1310,13 +1681,19 @@ def _extract_usage_value(html: str) -> Optional[int]:
     return None
 
 
+@functools.lru_cache(maxsize=2048)
 def _extract_code_from_url(url: str) -> str:
-    match = re.search(r"/promo/view/(\d+)", url)
+    match = PROMO_VIEW_ID_RE.search(url)
     if match:
         return f"promo-{match.group(1)}"
     return url
 
 
+def _has_hx_attr(tag) -> bool:
+    attrs = tag.attrs
+    return any(attr in attrs for attr in HX_ATTRS)
+
+
 def _collect_promo_view_links(
     session: requests.Session,
     race_id: str,
@@ -1334,9 +1711,13 @@ def _collect_promo_view_links(
         return tuple(sorted((str(k), str(v)) for k, v in data.items()))
 
     def _enqueue(method: str, url: str, data: Optional[dict[str, str]] = None) -> None:
-        normalized = _normalize_data(data)
-        queue.append((method.upper(), url, normalized))
-        logger.debug("Очередь➕ %s %s payload=%s", method.upper(), url, normalized)
+        # Повторы отсекаем при постановке в очередь, а не после извлечения.
+        task_key = (method.upper(), url, _normalize_data(data))
+        if task_key in visited:
+            return
+        visited.add(task_key)
+        queue.append(task_key)
+        logger.debug("Очередь➕ %s %s payload=%s", task_key[0], url, task_key[2])
 
     for template in PROMO_LIST_URLS:
         base_url = template.format(race_id=race_id)
@@ -1375,11 +1756,6 @@ def _collect_promo_view_links(
 
     while queue and request_count < max_requests:
         method, url, payload = queue.popleft()
-        task_key = (method, url, payload)
-        if task_key in visited:
-            logger.debug("Очередь↻ пропускаем %s %s", method, url)
-            continue
-        visited.add(task_key)
         request_count += 1
         logger.debug("Запрос #%s: %s %s payload=%s", request_count, method, url, payload)
 
@@ -1398,11 +1774,19 @@ def _collect_promo_view_links(
             text_plain = response.text
         except Exception:  # pragma: no cover
             text_plain = ""
-        text_unescaped = text_plain.replace("\\/", "/")
+        # Копию со снятым экранированием "\/" делаем, только если оно есть.
+        text_unescaped = text_plain.replace("\\/", "/") if "\\/" in text_plain else text_plain
         logger.debug("Ответ %s %s: %s байт", method, response.url, len(text_plain))
-        soup = BeautifulSoup(text_plain, "html.parser")
+        # Без ссылок на промо, пагинации и htmx-атрибутов из ответа нечего
+        # извлекать — не строим дерево и не гоняем регулярки.
+        if "/promo/" not in text_unescaped and "page=" not in text_unescaped and "hx-" not in text_unescaped:
+            continue
+        soup = BeautifulSoup(text_plain, "lxml")
         base = response.url
         found: List[Tuple[str, Optional[str], Optional[int]]] = []
+        # Регулярки находят те же ссылки, что и разбор тегов; голые (без текста
+        # и скидки) повторы внутри одного ответа не добавляем.
+        found_urls: set[str] = set()
         for tag in soup.find_all("a", href=True):
             href = tag["href"]
             if "/promo/view/" not in href:
@@ -1423,6 +1807,7 @@ def _collect_promo_view_links(
                     if discount_value is not None:
                         discount = discount_value
             found.append((full, text, discount))
+            found_urls.add(full)
         for attr in ("data-url", "data-href", "data-action"):
             for tag in soup.find_all(attrs={attr: True}):
                 value = tag.get(attr)
@@ -1431,33 +1816,41 @@ def _collect_promo_view_links(
                 full = urljoin(base, value.replace("\\/", "/"))
                 text = tag.get_text(strip=True) or None
                 found.append((full, text, None))
-        for pattern_source in (text_plain, text_unescaped):
-            for match in re.finditer(r"/promo/view/\d+(?:\?[^\s\"'>]*)?", pattern_source):
-                full = urljoin(base, match.group(0))
+                found_urls.add(full)
+        for match in PROMO_VIEW_PATH_RE.finditer(text_unescaped):
+            full = urljoin(base, match.group(0))
+            if full not in found_urls:
+                found_urls.add(full)
                 found.append((full, None, None))
-            for match in re.finditer(r'"(?:viewUrl|view_url)"\s*:\s*"([^"]+)"', pattern_source):
-                href = match.group(1)
-                if "/promo/view/" not in href:
-                    continue
-                full = urljoin(base, href)
+        for match in VIEW_URL_DQ_RE.finditer(text_unescaped):
+            href = match.group(1)
+            if "/promo/view/" not in href:
+                continue
+            full = urljoin(base, href)
+            if full not in found_urls:
+                found_urls.add(full)
                 found.append((full, None, None))
-            for match in re.finditer(r"'(?:viewUrl|view_url)'\s*:\s*'([^']+)'", pattern_source):
-                href = match.group(1)
-                if "/promo/view/" not in href:
-                    continue
-                full = urljoin(base, href)
+        for match in VIEW_URL_SQ_RE.finditer(text_unescaped):
+            href = match.group(1)
+            if "/promo/view/" not in href:
+                continue
+            full = urljoin(base, href)
+            if full not in found_urls:
+                found_urls.add(full)
                 found.append((full, None, None))
 
-        for match in re.finditer(r"promoViewUrl\s*=\s*['\"]([^'\"]+)['\"]", text_unescaped):
+        for match in PROMO_VIEW_URL_JS_RE.finditer(text_unescaped):
             href = match.group(1)
             if "/promo/view/" not in href:
                 continue
             full = urljoin(base, href)
-            found.append((full, None, None))
+            if full not in found_urls:
+                found_urls.add(full)
+                found.append((full, None, None))
 
-        hx_attrs = ["hx-get", "hx-post", "data-hx-get", "data-hx-post"]
-        for attr in hx_attrs:
-            for tag in soup.find_all(attrs={attr: True}):
+        # Один обход дерева для всех htmx-атрибутов вместо прохода на каждый.
+        for tag in soup.find_all(_has_hx_attr):
+            for attr in HX_ATTRS:
                 raw = tag.get(attr)
                 if not raw:
                     continue
@@ -1535,8 +1928,7 @@ def _gather_promos_with_usage(
     race_id: str,
     progress_cb: Optional[Callable[[int, int, str], None]] = None,
 ) -> List[PromoUsageInfo]:
-    session = requests.Session()
-    session.cookies = _load_cookies()
+    session = _get_shared_session()
     links = _collect_promo_view_links(session, race_id, progress_cb=progress_cb)
     if not links:
         logger.error("Промокоды не найдены для гонки %s", race_id)
@@ -1573,13 +1965,8 @@ async def setcookies(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None
     )
 
 
+@admin_only("read cookies")
 async def getcookies(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    user = update.effective_user
-    user_id = user.id if user else None
-    if ADMIN_IDS and user_id not in ADMIN_IDS:
-        await update.message.reply_text("⛔️ пошел на хуй пидарас")
-        logger.warning("User %s attempted to read cookies without permissions", user_id)
-        return
     path = Path(COOKIES_PATH)
     if not path.exists():
         await update.message.reply_text(f"⚠️ Cookie-файл {COOKIES_PATH} не найден.")